@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Set
 
 import discord
 from discord.ext import tasks, commands
@@ -16,12 +16,18 @@ class ChatArchiver(commands.Cog):
 
     @tasks.loop(hours=48)
     async def archive_stuff(self):
+        authors = set()
         for channel_id in self.monitored_channels:
             channel = self.bot.get_channel(channel_id)
             if channel:
-                await self.archive_channel(channel)
+                authors |= await self.archive_channel(channel)
 
-    async def archive_channel(self, channel: discord.TextChannel):
+        # Let other cogs catch up on what was just archived
+        if authors:
+            self.bot.dispatch('chat_archived', authors)
+
+    async def archive_channel(self, channel: discord.TextChannel) -> Set[int]:
+        """Archives a channel's new messages, returning who wrote them"""
         # print(f'Archiving channel #{channel.name}...')
 
         after = None
@@ -38,6 +44,7 @@ class ChatArchiver(commands.Cog):
 
         count = 0
         to_save = []
+        authors = set()
         try:
             async for msg in channel.history(limit=None, after=after):
                 to_save.append({
@@ -50,10 +57,12 @@ class ChatArchiver(commands.Cog):
 
                 if len(to_save) == 500:
                     count += await self._insert_many(to_save)
+                    authors.update(doc['author'] for doc in to_save)
                     to_save = []
 
             if to_save:
                 count += await self._insert_many(to_save)
+                authors.update(doc['author'] for doc in to_save)
 
             if count > 0:
                 print(f'Saved {count} messages from #{channel.name}')
@@ -61,6 +70,8 @@ class ChatArchiver(commands.Cog):
         except Exception as e:
             print(f'Something went wrong archiving #{channel.name}: {e}')
 
+        return authors
+
     async def _insert_many(self, documents: List[dict]) -> int:
         result = await self.archive.insert_many(documents)
         return len(result.inserted_ids)
@@ -1,27 +1,40 @@
 import asyncio
+import bisect
+import hashlib
+import itertools
+import json
 import logging
 import re
+import time
 from abc import abstractmethod
-from collections import Coroutine
+from collections import Coroutine, OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
-from typing import TypedDict, Union, List, Tuple, Optional
+from pathlib import Path
+from urllib.parse import urlsplit
+from typing import TypedDict, Union, List, Tuple, Optional, Dict, NamedTuple, Set
 import discord
 from PIL import Image
 from aiohttp import ClientSession
-from discord import slash_command, ApplicationContext, Member, Webhook, Message, Thread, HTTPException, Forbidden, \
-    WebhookMessage, File
+from discord import slash_command, ApplicationContext, Member, Message, HTTPException, WebhookMessage, File
 from discord.ext import commands, tasks
 from discord.types.webhook import PartialWebhook
 from motor.motor_asyncio import AsyncIOMotorCollection
-from pymongo import InsertOne, UpdateOne
-from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo import InsertOne, UpdateOne, ReplaceOne, DeleteOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure, PyMongoError
 from discord.utils import escape_markdown as nomd, MISSING
 
+from cogs import utils
+
 EMOTE_PATTERN = re.compile(r'\$([a-zA-Z0-9]+)')
 PARTIAL_CACHED_EMOTE = re.compile(r'(.*)~\d+$')
+CACHED_CHUNK = re.compile(r'(.+?)(?:_(\d+))?$')
 INVISIBLE_CHAR = '\u17B5'
 EMOTE_SIZE_LIMIT = 262144
+CHUNK_WIDTH = 48
+CHUNK_HEIGHT = 48
+MAX_CHUNKS = 3
 
 
 class CacheEmote:
@@ -29,6 +42,7 @@ class CacheEmote:
     def __init__(self, name):
         self.name = name
         self.chunks = []
+        self.media: Optional['EmoteMedia'] = None
 
     async def delete(self):
         delete_tasks = [asyncio.create_task(chunk.delete()) for chunk in self.chunks]
@@ -38,144 +52,525 @@ class CacheEmote:
         return ''.join(str(e) for e in self.chunks)
 
 
-class DatabaseEmote(TypedDict):
+class EmoteUsage:
+
+    def __init__(self, last_used: float = 0.0, score: float = 0.0, scored_at: float = 0.0):
+        self.last_used = last_used
+        self.score = score
+        self.scored_at = scored_at
+
+    def decayed_score(self, now: float, half_life: float) -> float:
+        return self.score * 0.5 ** ((now - self.scored_at) / half_life)
+
+    def hit(self, now: float, half_life: float):
+        self.score = self.decayed_score(now, half_life) + 1
+        self.scored_at = now
+        self.last_used = now
+
+
+class StatsRecorder:
+
+    def __init__(self, collection: AsyncIOMotorCollection, max_pending: int = 1000):
+        self.collection = collection
+        self.max_pending = max_pending
+
+        # Emote name -> counters to $inc and latest fields to $set
+        self.increments: Dict[str, Counter] = {}
+        self.updates: Dict[str, dict] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self.increments.keys() | self.updates.keys())
+
+    def increment(self, name: str, field: str, amount: int = 1):
+        self.increments.setdefault(name, Counter())[field] += amount
+        self.check_size()
+
+    def set(self, name: str, **fields):
+        self.updates.setdefault(name, {}).update(fields)
+        self.check_size()
+
+    def check_size(self):
+        # Keep memory bounded by flushing early rather than dropping counts
+        if len(self) >= self.max_pending and not self.flush_task:
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        increments, self.increments = self.increments, {}
+        updates, self.updates = self.updates, {}
+
+        bulk = []
+        for name in increments.keys() | updates.keys():
+            update = {}
+            if name in increments:
+                update['$inc'] = dict(increments[name])
+            if name in updates:
+                update['$set'] = updates[name]
+            bulk.append(UpdateOne({'_id': name}, update, upsert=True))
+
+        try:
+            if bulk:
+                await self.collection.bulk_write(bulk, ordered=False)
+        except Exception:
+            self.restore(increments, updates)
+            raise
+        finally:
+            # Cleared only once the write is done, so a failing database gets one early flush at a time
+            self.flush_task = None
+
+    def restore(self, increments: Dict[str, Counter], updates: Dict[str, dict]):
+        # Put a failed batch back for the next flush, fields set since then are newer and win
+        for name, counts in increments.items():
+            self.increments.setdefault(name, Counter()).update(counts)
+        for name, fields in updates.items():
+            self.updates[name] = {**fields, **self.updates.get(name, {})}
+
+
+def find_emotes(content: str) -> List[Tuple[int, int, str]]:
+    return [(m.start(), m.end(), m.group(1)) for m in EMOTE_PATTERN.finditer(content)]
+
+
+def replace_emotes(content: str, spans: List[Tuple[int, int, str]], replacements: Dict[str, str]) -> str:
+    parts = []
+    last = 0
+    for start, end, name in spans:
+        replacement = replacements.get(name)
+        if replacement is None:
+            continue
+        parts.append(content[last:start])
+        parts.append(replacement)
+        last = end
+    parts.append(content[last:])
+    return ''.join(parts)
+
+
+def split_chunk_name(chunk_name: str) -> Tuple[str, int]:
+    # 'pepeLaugh_1' -> ('pepeLaugh', 1)
+    match = CACHED_CHUNK.match(chunk_name)
+    return match.group(1), int(match.group(2) or 0)
+
+
+class EmoteMedia(TypedDict):
+    size: int
+    width: int
+    height: int
+    frames: int
+    ext: str
+    slices: int
+
+
+class DatabaseEmote(TypedDict, total=False):
     _id: str
     url: str
     src: Union[int, str]
+    animated: bool
+    media: EmoteMedia
 
 
-class ApiFetcher:
+def count_slices(width: int, height: int) -> int:
+    scale = min(1.0, CHUNK_WIDTH * MAX_CHUNKS / width, CHUNK_HEIGHT / height)
+    return max(1, round(width * scale / CHUNK_WIDTH))
+
+
+def probe_media(img_bytes: bytes) -> EmoteMedia:
+    with Image.open(BytesIO(img_bytes)) as img:
+        frames = getattr(img, 'n_frames', 1)
+        return EmoteMedia(
+            size=len(img_bytes),
+            width=img.width,
+            height=img.height,
+            frames=frames,
+            ext=(img.format or 'png').lower(),
+            slices=1 if frames > 1 else count_slices(img.width, img.height)
+        )
+
+
+class CachedImage(NamedTuple):
+    data: bytes
+    content_type: str
+
+
+# Keyed by URL and deduplicated by content hash, stale entries are revalidated with ETag/Last-Modified
+class ImageCache:
+
+    def __init__(self, session: ClientSession, root: str = '.cache/emotes', max_bytes: int = 256 * 1024 * 1024,
+                 max_age: float = 86400):
+        self.session = session
+        self.root = Path(root)
+        self.blobs = self.root / 'blobs'
+        self.index_path = self.root / 'index.json'
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+        # URL -> {'hash', 'content_type', 'etag', 'last_modified', 'checked'}, least recently used first
+        self.entries: 'OrderedDict[str, dict]' = OrderedDict()
+        self.refs: Dict[str, int] = {}
+        self.sizes: Dict[str, int] = {}
+        self.save_task: Optional[asyncio.Task] = None
+        self.downloads = utils.SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+        self.load()
+
+    @property
+    def used_bytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def blob_path(self, digest: str) -> Path:
+        return self.blobs / digest[:2] / digest
+
+    def load(self):
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        try:
+            entries = json.loads(self.index_path.read_text())
+        except (OSError, ValueError):
+            entries = {}
+
+        on_disk = {p.name: p.stat().st_size for p in self.blobs.glob('*/*')}
+        for url, entry in entries.items():
+            if entry['hash'] in on_disk:
+                self.entries[url] = entry
+                self.refs[entry['hash']] = self.refs.get(entry['hash'], 0) + 1
+                self.sizes[entry['hash']] = on_disk[entry['hash']]
+
+        # Drop blobs left behind by an index that was never saved
+        for digest in on_disk.keys() - self.refs.keys():
+            self.blob_path(digest).unlink(missing_ok=True)
+
+    def save(self):
+        tmp_path = self.index_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self.entries))
+        tmp_path.replace(self.index_path)
+
+    async def save_later(self, delay: float = 10.0):
+        await asyncio.sleep(delay)
+        self.save_task = None
+        await asyncio.to_thread(self.save)
+
+    def schedule_save(self):
+        if not self.save_task:
+            self.save_task = asyncio.create_task(self.save_later())
+
+    async def read_blob(self, digest: str) -> Optional[bytes]:
+        try:
+            return await asyncio.to_thread(self.blob_path(digest).read_bytes)
+        except OSError:
+            return None
 
-    def __init__(self, collection: AsyncIOMotorCollection, session: ClientSession):
+    async def write_blob(self, digest: str, data: bytes):
+        path = self.blob_path(digest)
+        if digest in self.sizes:
+            return
+
+        def write():
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(data)
+
+        await asyncio.to_thread(write)
+        self.sizes[digest] = len(data)
+
+    def forget(self, url: str):
+        entry = self.entries.pop(url, None)
+        if not entry:
+            return
+
+        digest = entry['hash']
+        self.refs[digest] -= 1
+        if self.refs[digest] < 1:
+            del self.refs[digest]
+            self.sizes.pop(digest, None)
+            self.blob_path(digest).unlink(missing_ok=True)
+
+    def evict(self):
+        while self.entries and self.used_bytes > self.max_bytes:
+            self.forget(next(iter(self.entries)))
+
+    async def get(self, url: str) -> Optional[CachedImage]:
+        entry = self.entries.get(url)
+
+        if entry and time.time() - entry['checked'] < self.max_age:
+            data = await self.read_blob(entry['hash'])
+            if data is not None:
+                self.entries.move_to_end(url)
+                self.hits += 1
+                return CachedImage(data, entry['content_type'])
+
+        # Concurrent misses for the same URL share one download, so its blob is only counted once
+        return await self.downloads.run(url, lambda: self.download(url))
+
+    async def download(self, url: str) -> Optional[CachedImage]:
+        entry = self.entries.get(url)
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 304 and entry:
+                data = await self.read_blob(entry['hash'])
+                if data is not None:
+                    entry['checked'] = time.time()
+                    self.entries.move_to_end(url)
+                    self.revalidated += 1
+                    self.schedule_save()
+                    return CachedImage(data, entry['content_type'])
+
+            if response.status != 200:
+                if entry:  # Stale or missing blob, let the next request start over
+                    self.forget(url)
+                return None
+
+            data = await response.read()
+            content_type = response.headers.get('Content-Type', '')
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        self.misses += 1
+        self.forget(url)
+
+        digest = hashlib.sha256(data).hexdigest()
+        await self.write_blob(digest, data)
+        self.refs[digest] = self.refs.get(digest, 0) + 1
+        self.entries[url] = {
+            'hash': digest,
+            'content_type': content_type,
+            'etag': etag,
+            'last_modified': last_modified,
+            'checked': time.time()
+        }
+
+        self.evict()
+        self.schedule_save()
+        return CachedImage(data, content_type)
+
+    def flush(self):
+        if self.save_task:
+            self.save_task.cancel()
+            self.save_task = None
+        self.save()
+
+
+class ApiFetcher:
+    name = 'API'
+    src = 'api'
+    sections: Dict[str, str] = {}
+    max_pages = 1
+    page_concurrency = 4
+    probe_workers = 8
+    batch_size = 500
+
+    # Shared by every fetcher so two sources on the same CDN can't double up on it
+    host_limit = 4
+    host_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def __init__(self, collection: AsyncIOMotorCollection, session: ClientSession, images: ImageCache):
         self.collection = collection
         self.session = session
+        self.images = images
+        self.run = None
 
     @abstractmethod
-    async def fetch(self) -> int:
-        raise NotImplementedError("API fetcher must implement fetch()")
+    async def fetch_page(self, url: str, page: int) -> list:
+        raise NotImplementedError("API fetcher must implement fetch_page()")
 
-    async def save_emotes(self, database_emotes: List[DatabaseEmote]):
-        num_inserted = 0
+    @abstractmethod
+    async def to_emote(self, item: dict) -> Optional[DatabaseEmote]:
+        raise NotImplementedError("API fetcher must implement to_emote()")
+
+    def stage(self, emote: DatabaseEmote, rank: int) -> InsertOne:
+        # Duplicate names are all kept, the lowest rank (most popular) wins when syncing
+        staged = {k: v for k, v in emote.items() if k != '_id'}
+        staged.update({'name': emote['_id'], 'src': self.src, 'rank': rank, 'run': self.run})
+        return InsertOne(staged)
+
+    async def get_json(self, url: str, params: Optional[dict] = None):
+        host = urlsplit(url).hostname
+        semaphore = self.host_semaphores.setdefault(host, asyncio.Semaphore(self.host_limit))
+        async with semaphore:
+            async with self.session.get(url, params=params) as r:
+                r.raise_for_status()
+                return await r.json()
+
+    async def write(self, bulk: list) -> int:
         try:
-            result = await self.collection.insert_many(database_emotes, ordered=False)
+            result = await self.collection.bulk_write(bulk, ordered=False)
         except BulkWriteError as bwe:
-            num_inserted = bwe.details['nInserted']
+            details = bwe.details
+            return details['nInserted']
         else:
-            num_inserted = len(result.inserted_ids)
+            return result.inserted_count
+
+    async def fetch_section(self, section_idx: int, section: str, url: str) -> int:
+        items = asyncio.Queue(maxsize=self.batch_size * 2)
+        pending = []
+        pages = iter(range(self.max_pages))
+        exhausted = False
+        failure: Optional[Exception] = None
+        progress = {'pages': 0, 'items': 0, 'written': 0}
+        start = time.perf_counter()
+
+        def report():
+            elapsed = time.perf_counter() - start
+            print(f'[{self.name}] {section}: {progress["pages"]} pages, {progress["items"]} emotes, '
+                  f'{progress["written"]} written in {elapsed:.1f}s ({progress["items"] / elapsed:.1f} emotes/s)')
+
+        async def flush():
+            if pending:
+                bulk = pending[:]
+                pending.clear()
+                progress['written'] += await self.write(bulk)
+
+        async def page_worker():
+            nonlocal exhausted
+            for page in pages:
+                if exhausted:
+                    break
+                data = await self.fetch_page(url, page)
+                if not isinstance(data, list):  # An error body, not an empty last page
+                    raise ValueError(f'Unexpected response for {section} page {page}: {str(data)[:100]}')
+                if not data:
+                    exhausted = True
+                    break
+                for i, item in enumerate(data):
+                    await items.put(((section_idx * self.max_pages + page) * 1000 + i, item))
+                progress['pages'] += 1
+                if progress['pages'] % 10 == 0:
+                    report()
+
+        async def probe(rank: int, item: dict):
+            nonlocal exhausted, failure
+            try:
+                emote = await self.to_emote(item)
+            except Exception as e:
+                logging.warning(f'[{self.name}] Skipped emote: {e}')
+                return
+
+            progress['items'] += 1
+            if emote:
+                pending.append(self.stage(emote, rank))
+            if len(pending) >= self.batch_size:
+                try:
+                    await flush()
+                except Exception as e:  # A lost batch would make the sync delete live emotes, fail the section
+                    logging.error(f'[{self.name}] Could not write staged emotes: {e}')
+                    failure = e
+                    exhausted = True
+
+        async def probe_worker():
+            while True:
+                rank, item = await items.get()
+                try:
+                    if not failure:  # Otherwise just drain the queue so the page workers can stop
+                        await probe(rank, item)
+                finally:
+                    items.task_done()
+
+        probes = [asyncio.create_task(probe_worker()) for _ in range(self.probe_workers)]
+        page_workers = [asyncio.create_task(page_worker()) for _ in range(self.page_concurrency)]
+        try:
+            await asyncio.gather(*page_workers)
+            await items.join()
         finally:
-            print(f'[...] Inserted {num_inserted}')
+            for task in page_workers + probes:
+                task.cancel()
+
+        if failure:
+            raise failure
+
+        await flush()
+        report()
+        return progress['written']
+
+    async def fetch(self, run: int) -> int:
+        print(f'[{self.name}] Beggining fetch')
+        self.run = run
+        for section_idx, (section, url) in enumerate(self.sections.items()):
+            await self.fetch_section(section_idx, section, url)
+        return await self.collection.count_documents({'src': self.src, 'run': run})
 
 
 class BttvFetcher(ApiFetcher):
-    urls = {
+    name = 'BTTV'
+    src = 'bttv'
+    sections = {
         'trending': 'https://api.betterttv.net/3/emotes/shared/trending',
         'shared': 'https://api.betterttv.net/3/emotes/shared/top'
     }
-    params = {'offset': 0, 'limit': 100}
-
-    async def fetch(self) -> int:
-
-        print(f'[BTTV] Beggining fetch')
-
-        for section, api_url in self.urls.items():
-            for i in range(0, 300):
-                bulk = []
-                self.params['offset'] = i * 100
-                async with self.session.get(api_url, params=self.params) as r:
-
-                    data = await r.json()
-                    for e in data:
-
-                        id_ = e["emote"]["id"]
-                        name = e['emote']['code']
-                        animated = e['emote']['imageType'] == 'gif'
-                        url = f'https://cdn.betterttv.net/emote/{id_}/2x'
-
-                        if animated:
-                            # Check if the standard emote is too big for discord
-                            async with self.session.get(url) as r2:
-                                if len(await r2.read()) > EMOTE_SIZE_LIMIT:
-                                    # If it is, try using a smaller version
-                                    url = f'https://cdn.betterttv.net/emote/{id_}/1x'
-                                    async with self.session.get(url) as r3:
-                                        if len(await r3.read()) > EMOTE_SIZE_LIMIT:
-                                            # If it's still too big, use the static version
-                                            url = f'https://cache.ffzap.com/https://cdn.betterttv.net/emote/{id_}/2x'
-
-                        bulk.append(InsertOne({'_id': name, 'src': 'bttv', 'url': url, 'animated': animated}))
-
-                    if bulk:
-                        try:
-                            await self.collection.bulk_write(bulk, ordered=False)
-                        except BulkWriteError as bwe:
-                            num_inserted = bwe.details['nInserted']
-                        else:
-                            # HACKHACK: result.inserted_ids is failing, assume the max got inserted
-                            num_inserted = 100
-                            # num_inserted = len(result.inserted_ids)
-                        finally:
-                            print(f'[BTTV] Inserted {num_inserted}')
-
-        new_total = await self.collection.count_documents({'src': 'bttv'})
-        return new_total
+    max_pages = 300
 
+    async def fetch_page(self, url: str, page: int) -> list:
+        return await self.get_json(url, params={'offset': page * 100, 'limit': 100})
 
-class FfzFetcher(ApiFetcher):
-    url = 'https://api.frankerfacez.com/v1/emoticons'
-    params = {
-        'high_dpi': 'off',
-        'sort': 'count-desc',
-        'per_page': 200,
-        'page': 1
-    }
+    async def to_emote(self, item: dict) -> Optional[DatabaseEmote]:
+        id_ = item["emote"]["id"]
+        name = item['emote']['code']
+        animated = item['emote']['imageType'] == 'gif'
+        url = f'https://cdn.betterttv.net/emote/{id_}/2x'
 
-    async def fetch(self):
+        emote = DatabaseEmote(_id=name, src=self.src, url=url, animated=animated)
 
-        print(f'[FFZ] Beggining fetch')
+        if animated:
+            # Check if the standard emote is too big for discord
+            image = await self.images.get(url)
+            if image and len(image.data) > EMOTE_SIZE_LIMIT:
+                # If it is, try using a smaller version
+                url = f'https://cdn.betterttv.net/emote/{id_}/1x'
+                image = await self.images.get(url)
+                if image and len(image.data) > EMOTE_SIZE_LIMIT:
+                    # If it's still too big, use the static version
+                    url = f'https://cache.ffzap.com/https://cdn.betterttv.net/emote/{id_}/2x'
+                    image = None
 
-        while self.params['page'] <= 200:
-            async with self.session.get(self.url, params=self.params) as r:
-                data = await r.json()
-                bulk = []
-                for e in data['emoticons']:
-                    name = e['name']
-                    url = f"https:{e['urls'].get('2') or e['urls'].get('1')}"
-                    bulk.append(UpdateOne(
-                        {'_id': name, 'src': 'bttv', 'animated': False},
-                        {'$set': {'src': 'ffz', 'url': url}},
-                        upsert=True
-                    ))
+            # We already paid for the download, keep what we learned about the chosen variant
+            emote['url'] = url
+            if image:
+                emote['media'] = await asyncio.to_thread(probe_media, image.data)
 
-                if not bulk:
-                    continue
+        return emote
 
-                # TODO: Now that we update rather than insert, num_inserted returns 0
-                num_inserted = 0
-                try:
-                    result = await self.collection.bulk_write(bulk, ordered=False)
-                except BulkWriteError as bwe:
-                    num_inserted = bwe.details['nInserted']
-                else:
-                    num_inserted = len(result.inserted_ids)
-                finally:
-                    # FIXME: result.inserted_ids not accurate?
-                    print(f'[FFZ] Inserted {num_inserted}')
 
-            self.params['page'] += 1
+class FfzFetcher(ApiFetcher):
+    name = 'FFZ'
+    src = 'ffz'
+    sections = {'top': 'https://api.frankerfacez.com/v1/emoticons'}
+    max_pages = 200
 
-        new_total = await self.collection.count_documents({'src': 'ffz'})
-        return new_total
+    async def fetch_page(self, url: str, page: int) -> list:
+        data = await self.get_json(url, params={
+            'high_dpi': 'off',
+            'sort': 'count-desc',
+            'per_page': 200,
+            'page': page + 1
+        })
+        return data['emoticons']
+
+    async def to_emote(self, item: dict) -> Optional[DatabaseEmote]:
+        name = item['name']
+        url = f"https:{item['urls'].get('2') or item['urls'].get('1')}"
+        return DatabaseEmote(_id=name, src=self.src, url=url, animated=False)
+
+
+class SyncRefused(Exception):
+    pass
 
 
 class EmoteCollectionUpdater(commands.Cog):
+    MANAGED_SOURCES = ['bttv', 'ffz']
+    MIN_STAGED_RATIO = 0.5  # a source that stages less than this share of its live emotes is assumed broken
 
-    def __init__(self, emotes, logs, session):
+    def __init__(self, emotes, staging, logs, session, images):
         self.session = session
         self.emotes = emotes
+        self.staging = staging
         self.logs = logs
 
-        self.bttv = BttvFetcher(collection=self.emotes, session=self.session)
-        self.ffz = FfzFetcher(collection=self.emotes, session=self.session)
+        self.bttv = BttvFetcher(collection=self.staging, session=self.session, images=images)
+        self.ffz = FfzFetcher(collection=self.staging, session=self.session, images=images)
 
     async def get_last_update_info(self) -> Tuple[Optional[datetime], Optional[bool]]:
         result = await self.logs.find_one({'_id': 'lastEmoteCollectionUpdate'})
@@ -183,20 +578,127 @@ class EmoteCollectionUpdater(commands.Cog):
             return result['date'], result['success']
         return None, None
 
-    async def check_for_updates(self):
+    async def check_for_updates(self) -> bool:
         logging.debug(f'Checking for emote updates..')
         last_update_time, success = await self.get_last_update_info()
         logging.debug(f'Last update: {last_update_time} (Success: {success})')
-        if not success or not datetime or (datetime.now() - last_update_time).days > 7:
+        if not success or not last_update_time or (datetime.now() - last_update_time).days > 7:
             await self.update()
+            return True
+        return False
+
+    async def get_sync_state(self) -> dict:
+        # Resumes an unfinished run, if there is one
+        state = await self.logs.find_one({'_id': 'emoteSync'})
+        if state and not state.get('applied'):
+            return state
+
+        state = {'_id': 'emoteSync', 'run': int(time.time()), 'started': datetime.now(), 'staged': [],
+                 'applied': False}
+        await self.staging.delete_many({})
+        await self.staging.create_index('rank')
+        await self.logs.replace_one({'_id': 'emoteSync'}, state, upsert=True)
+        return state
+
+    async def stage(self, fetcher: 'ApiFetcher', state: dict):
+        if fetcher.src in state['staged']:
+            print(f'[{fetcher.name}] Already staged for run {state["run"]}, skipping fetch')
+            return
+
+        # Throw away whatever a previous, interrupted attempt left behind for this source
+        await self.staging.delete_many({'src': fetcher.src})
+        await fetcher.fetch(state['run'])
+
+        state['staged'].append(fetcher.src)
+        await self.logs.update_one({'_id': 'emoteSync'}, {'$addToSet': {'staged': fetcher.src}})
+
+    async def verify_staged(self):
+        # The delta would delete every live emote a broken source is missing, so throw its stage away and refuse
+        broken = []
+        for src in self.MANAGED_SOURCES:
+            staged = await self.staging.count_documents({'src': src})
+            live = await self.emotes.count_documents({'src': src})
+            if live and staged < live * self.MIN_STAGED_RATIO:
+                broken.append(f'{src} ({staged} staged, {live} live)')
+                await self.staging.delete_many({'src': src})
+                await self.logs.update_one({'_id': 'emoteSync'}, {'$pull': {'staged': src}})
+
+        if broken:
+            raise SyncRefused(f'Refusing to sync, sources shrank too much: {", ".join(broken)}')
+
+    async def build_target(self) -> Dict[str, dict]:
+        target = {}
+        for src in self.MANAGED_SOURCES:
+            async for doc in self.staging.find({'src': src}).sort('rank', 1):
+                name = doc['name']
+                emote = {k: v for k, v in doc.items() if k not in ('_id', 'name', 'rank', 'run')}
+                emote['_id'] = name
+                current = target.get(name)
+                if not current:
+                    target[name] = emote
+                elif current['src'] == 'bttv' and src == 'ffz' and not current['animated']:
+                    # FFZ takes over static BTTV emotes, animated BTTV ones stay
+                    target[name] = emote
+        return target
+
+    async def compute_delta(self, target: Dict[str, dict]) -> list:
+        live = {}
+        async for doc in self.emotes.find({'src': {'$in': self.MANAGED_SOURCES}}):
+            live[doc['_id']] = doc
+
+        # Never touch emotes added by users
+        unmanaged = set()
+        async for doc in self.emotes.find({'src': {'$nin': self.MANAGED_SOURCES}}, {'_id': 1}):
+            unmanaged.add(doc['_id'])
+
+        managed_filter = {'$in': self.MANAGED_SOURCES}
+        delta = []
+        for name, emote in target.items():
+            if name in unmanaged:
+                continue
+            current = live.get(name)
+            if not current:
+                delta.append(InsertOne(emote))
+            elif any(current.get(k) != v for k, v in emote.items()):
+                delta.append(ReplaceOne({'_id': name, 'src': managed_filter}, emote))
+
+        for name in live.keys() - target.keys():
+            delta.append(DeleteOne({'_id': name, 'src': managed_filter}))
+
+        return delta
+
+    async def apply_delta(self, delta: list):
+        if not delta:
+            return
+
+        client = self.emotes.database.client
+        try:
+            async with await client.start_session() as session:
+                async with session.start_transaction():
+                    await self.emotes.bulk_write(delta, ordered=False, session=session)
+        except OperationFailure as e:
+            if e.code != 20:  # IllegalOperation, transactions need a replica set
+                raise
+            logging.warning('Transactions unsupported, applying emote delta without one')
+            await self.emotes.bulk_write(delta, ordered=False)
 
     async def update(self):
         logging.debug('Begin emote update..')
         success = False
         try:
-            await self.emotes.delete_many({'src': {'$in': ['bttv', 'ffz']}})
-            await self.bttv.fetch()
-            await self.ffz.fetch()
+            state = await self.get_sync_state()
+            for fetcher in [self.bttv, self.ffz]:
+                await self.stage(fetcher, state)
+
+            await self.verify_staged()
+            delta = await self.compute_delta(await self.build_target())
+            counts = Counter(type(op).__name__ for op in delta)
+            print(f'[Sync] Applying {counts["InsertOne"]} inserts, {counts["ReplaceOne"]} updates, '
+                  f'{counts["DeleteOne"]} removals')
+            await self.apply_delta(delta)
+
+            await self.logs.update_one({'_id': 'emoteSync'}, {'$set': {'applied': True}})
+            await self.staging.delete_many({})
         except Exception as e:
             logging.error(f'Something went wrong updating the emote collection: {e}')
         else:
@@ -208,135 +710,489 @@ class EmoteCollectionUpdater(commands.Cog):
             upsert=True)
 
 
-class Cache:
-    BUFFER_SIZE = 8
+def preprocess_emote(img_bytes: bytes) -> List[bytes]:
+
+    MIN_HEIGHT = CHUNK_HEIGHT
+    MIN_WIDTH = CHUNK_WIDTH
+    MAX_WIDTH = MIN_WIDTH * MAX_CHUNKS
+
+    with Image.open(BytesIO(img_bytes)) as img:
+
+        if getattr(img, 'is_animated', False):
+            return [img_bytes]
+
+        # Resize and pad with transparency
+        img.thumbnail((MAX_WIDTH, MIN_HEIGHT))
+        num_slices = count_slices(*img.size)
+
+        # Skip padding for single-cell emotes, not worth it
+        if num_slices == 1:
+            with BytesIO() as io:
+                img.save(io, 'PNG')
+                io.seek(0)
+                return [io.read()]
+        else:
+            cells = []
+            bg_width = MIN_WIDTH * num_slices
+            bg = Image.new('RGBA', (bg_width, MIN_HEIGHT), (255, 255, 255, 0))
+            bg.paste(img)
+
+            # Chop it up
+            for i in range(num_slices):
+                left = i * MIN_WIDTH
+                right = left + MIN_WIDTH
+                bbox = (left, 0, right, MIN_HEIGHT)
+                cell = img.crop(bbox)
+                with BytesIO() as io:
+                    cell.save(io, 'PNG')
+                    io.seek(0)
+                    cells.append(io.read())
+
+            return cells
+
 
-    def __init__(self, guild, session):
+def composite_emotes(images: List[bytes]) -> bytes:
+    # Animated emotes only keep their first frame
+
+    GAP = 4
+
+    frames = []
+    for img_bytes in images:
+        with Image.open(BytesIO(img_bytes)) as img:
+            frame = img.convert('RGBA')
+            frame.thumbnail((CHUNK_WIDTH * MAX_CHUNKS, CHUNK_HEIGHT))
+            frames.append(frame)
+
+    width = sum(frame.width for frame in frames) + GAP * (len(frames) - 1)
+    strip = Image.new('RGBA', (width, CHUNK_HEIGHT), (255, 255, 255, 0))
+    x = 0
+    for frame in frames:
+        strip.paste(frame, (x, (CHUNK_HEIGHT - frame.height) // 2))
+        x += frame.width + GAP
+
+    with BytesIO() as io:
+        strip.save(io, 'PNG')
+        return io.getvalue()
+
+
+def preprocess_and_probe(img_bytes: bytes) -> Tuple[List[bytes], EmoteMedia]:
+    return preprocess_emote(img_bytes), probe_media(img_bytes)
+
+
+class PreprocessorBusy(Exception):
+    pass
+
+
+class Preprocessor:
+    EXECUTORS = ('process', 'thread')
+
+    def __init__(self, executor: str = 'process', workers: int = 2, max_queue: int = 16):
+        if executor not in self.EXECUTORS:
+            raise ValueError(f'Unknown executor {executor}, expected one of {self.EXECUTORS}')
+
+        if executor == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='emoter-preprocess')
+
+        self.kind = executor
+        self.max_queue = max_queue
+        self.pending = 0
+
+        self.jobs = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_queue:
+            raise PreprocessorBusy(f'{self.pending} jobs already queued')
+
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.pending -= 1
+            self.jobs += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.jobs if self.jobs else 0.0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class HashRing:
+    REPLICAS = 64
+
+    def __init__(self, nodes: List[int]):
+        self.ring: List[Tuple[int, int]] = sorted(
+            (self.hash(f'{node}:{i}'), node) for node in nodes for i in range(self.REPLICAS))
+        self.keys = [h for h, _ in self.ring]
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def get(self, key: str) -> int:
+        pos = bisect.bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.ring[pos][1]
+
+
+# TinyLFU-style count-min sketch, counters saturate at 15 and are halved every sample_size increments
+class FrequencySketch:
+    DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, width: int = 4096, sample_size: Optional[int] = None):
+        self.width = width
+        self.sample_size = sample_size or width * 10
+        self.rows = [bytearray(width) for _ in range(self.DEPTH)]
+        self.additions = 0
+
+    def indexes(self, key: str) -> List[int]:
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=4 * self.DEPTH).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'big') % self.width for i in range(self.DEPTH)]
+
+    def increment(self, key: str):
+        for row, i in zip(self.rows, self.indexes(key)):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.age()
+
+    def estimate(self, key: str) -> int:
+        return min(row[i] for row, i in zip(self.rows, self.indexes(key)))
+
+    def age(self):
+        for row in self.rows:
+            row[:] = bytes(count >> 1 for count in row)
+        self.additions //= 2
+
+
+# One queue per storage guild: user uploads first, then background work, then evictions in batches
+class EmojiScheduler:
+    USER = 0
+    BACKGROUND = 1
+    EVICT = 2
+
+    EVICT_DELAY = 2.0  # seconds the queue must stay quiet before evictions run
+    EVICT_MAX_DEFER = 30.0  # evictions run regardless once they've waited this long
+    SLOW_CALL = 1.0  # calls slower than this were most likely held back by a rate limit
+
+    def __init__(self, guild):
         self.guild = guild
-        self.session = session
+        self.queue = asyncio.PriorityQueue()
+        self.order = itertools.count()
+        self.wakeup = asyncio.Event()
 
-        # Ensure a BUFFER_SIZE gap between new insertions and deletions
-        asyncio.create_task(self.ensure_space())
+        # Deferred evictions, kept out of the queue so they never hold up the worker
+        self.evictions: List[Tuple[discord.Emoji, asyncio.Future]] = []
+        self.evictions_since = 0.0
+
+        # Deletes not done yet, and deletes done that the guild's emoji list hasn't caught up with
+        self.pending_deletes: Dict[int, asyncio.Future] = {}
+        self.deleted: Set[int] = set()
+
+        # Operation -> what we've seen of its rate limit bucket
+        self.buckets: Dict[str, dict] = {
+            op: {'calls': 0, 'throttled': 0, 'last_throttled': 0.0} for op in ('create', 'delete')
+        }
+
+        self.worker = asyncio.create_task(self.run())
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() + len(self.evictions)
+
+    def submit(self, priority: int, op: str, arg, future: Optional[asyncio.Future] = None) -> asyncio.Future:
+        future = future or asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self.order), op, arg, future))
+        self.wakeup.set()
+        return future
+
+    def create(self, name: str, image: bytes, priority: int = USER) -> asyncio.Future:
+        return self.submit(priority, 'create', (name, image))
+
+    def delete(self, emoji: discord.Emoji, priority: int = EVICT) -> asyncio.Future:
+        future = self.pending_deletes.get(emoji.id)
+        if future and priority == self.EVICT:
+            return future
+
+        if not future:
+            future = asyncio.get_running_loop().create_future()
+            self.pending_deletes[emoji.id] = future
+            if priority == self.EVICT:
+                if not self.evictions:
+                    self.evictions_since = time.monotonic()
+                self.evictions.append((emoji, future))
+                self.wakeup.set()
+                return future
+
+        # Urgent requests for an already deferred delete jump the queue, sharing its future
+        return self.submit(priority, 'delete', emoji, future)
+
+    def expedite_deletes(self) -> List[asyncio.Future]:
+        evictions, self.evictions = self.evictions, []
+        for emoji, future in evictions:
+            self.submit(self.USER, 'delete', emoji, future)
+        return list(self.pending_deletes.values())
+
+    def is_deleting(self, emoji: discord.Emoji) -> bool:
+        return emoji.id in self.pending_deletes or emoji.id in self.deleted
+
+    def on_emojis_update(self, after_ids: Set[int]):
+        self.deleted &= after_ids
+
+    def observe(self, op: str, elapsed: float, throttled: bool = False):
+        bucket = self.buckets[op]
+        bucket['calls'] += 1
+        if throttled or elapsed > self.SLOW_CALL:
+            bucket['throttled'] += 1
+            bucket['last_throttled'] = time.monotonic()
+
+    async def execute(self, op: str, arg, future: asyncio.Future):
+        if future.done():  # Cancelled by the requester or already handled at a higher priority
+            return
+
+        start = time.monotonic()
+        throttled = False
+        try:
+            if op == 'create':
+                name, image = arg
+                result = await self.guild.create_custom_emoji(name=name, image=image)
+            else:
+                result = await arg.delete()
+                self.deleted.add(arg.id)
+        except HTTPException as e:
+            throttled = e.status == 429
+            if not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self.observe(op, time.monotonic() - start, throttled)
+            if op == 'delete':
+                self.pending_deletes.pop(arg.id, None)
+
+    async def run_evictions(self):
+        evictions, self.evictions = self.evictions, []
+        await asyncio.gather(*[self.execute('delete', emoji, future) for emoji, future in evictions])
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+
+            overdue = self.evictions and time.monotonic() - self.evictions_since > self.EVICT_MAX_DEFER
+            if overdue:
+                await self.run_evictions()
+            elif not self.queue.empty():
+                await self.execute(*self.queue.get_nowait()[2:])
+            elif self.evictions:
+                # Wait for a quiet moment, waking up right away for anything more urgent
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.EVICT_DELAY)
+                except asyncio.TimeoutError:
+                    await self.run_evictions()
+            else:
+                await self.wakeup.wait()
 
-    def get_emote(self, name: str) -> CacheEmote:
-        chunks = [e for e in self.guild.emojis if re.match(fr'{re.escape(name)}(_\d+)?$', e.name)]
+    def close(self):
+        self.worker.cancel()
+
+
+class CacheShard:
+
+    def __init__(self, cache: 'Cache', guild):
+        self.cache = cache
+        self.guild = guild
+        self.session = cache.session
+        self.scheduler = EmojiScheduler(guild)
+
+        # Base emote name -> its chunks, ordered by position
+        self.index: Dict[str, List[discord.Emoji]] = {}
+        self.rebuild_index()
+
+    def rebuild_index(self):
+        self.index.clear()
+        for emoji in self.emojis:
+            self.index_chunk(emoji)
+
+    def index_chunk(self, emoji: discord.Emoji):
+        name, _ = split_chunk_name(emoji.name)
+        chunks = [c for c in self.index.get(name, []) if c.id != emoji.id]
+        chunks.append(emoji)
+        chunks.sort(key=lambda c: split_chunk_name(c.name)[1])
+        self.index[name] = chunks
+
+    def unindex_chunk(self, emoji: discord.Emoji):
+        name, _ = split_chunk_name(emoji.name)
+        chunks = [c for c in self.index.get(name, []) if c.id != emoji.id]
+        if chunks:
+            self.index[name] = chunks
+        else:
+            self.index.pop(name, None)
+
+    def verify_index(self) -> bool:
+        indexed = {c.id for chunks in self.index.values() for c in chunks}
+        actual = {e.id for e in self.emojis}
+        if indexed == actual:
+            return True
+
+        logging.warning(f'Emote cache index for {self.guild.id} drifted '
+                        f'({len(indexed)} indexed, {len(actual)} in guild), rebuilding')
+        self.rebuild_index()
+        return False
+
+    def on_emojis_update(self, before: List[discord.Emoji], after: List[discord.Emoji]):
+        before_ids = {e.id for e in before}
+        after_ids = {e.id for e in after}
+        self.scheduler.on_emojis_update(after_ids)
+
+        for emoji in before:
+            if emoji.id not in after_ids:
+                self.unindex_chunk(emoji)
+        for emoji in after:
+            if emoji.id not in before_ids:
+                self.index_chunk(emoji)
+
+        self.verify_index()
+
+    def get_emote(self, name: str) -> Optional[CacheEmote]:
+        chunks = self.index.get(name)
         if chunks:
             emote = CacheEmote(name)
-            emote.chunks = chunks
+            emote.chunks = list(chunks)
             return emote
 
+    @property
+    def emojis(self) -> List[discord.Emoji]:
+        # Leaves out emojis queued for deletion
+        return [e for e in self.guild.emojis if not self.scheduler.is_deleting(e)]
+
+    @property
+    def occupied(self) -> List[discord.Emoji]:
+        # Emojis queued for deletion still take up a slot until they are gone
+        return [e for e in self.guild.emojis if e.id not in self.scheduler.deleted]
+
     async def evict_emotes(self, count: int):
-        tail = sorted(self.guild.emojis, key=lambda e: e.created_at, reverse=False)[:count]
-        delete_tasks = [asyncio.create_task(self.delete_emote(e.name)) for e in tail]
+        tail = self.cache.eviction_order(self.emojis)[:count]
+        delete_tasks = [asyncio.create_task(self.delete_emote(split_chunk_name(e.name)[0])) for e in tail]
         await asyncio.gather(*delete_tasks)
 
-    async def delete_emote(self, name: str):
+    async def delete_emote(self, name: str, priority: int = EmojiScheduler.EVICT):
         emote = self.get_emote(name)
         if emote:
-            await emote.delete()
+            self.index.pop(name, None)
+            await asyncio.gather(*[self.scheduler.delete(chunk, priority) for chunk in emote.chunks])
 
     async def purge(self):
-        for emote in self.guild.emojis:
-            await emote.delete()
-
-    @staticmethod
-    def preprocess_emote(img_bytes: bytes) -> List[bytes]:
+        self.index.clear()
+        await asyncio.gather(
+            *[self.scheduler.delete(e, EmojiScheduler.BACKGROUND) for e in self.occupied],
+            return_exceptions=True)
 
-        MIN_HEIGHT = 48
-        MIN_WIDTH = 48
-        MAX_WIDTH = MIN_WIDTH * 3
-
-        with Image.open(BytesIO(img_bytes)) as img:
+    async def upload_emote(self, name: str, url: str, media: Optional[EmoteMedia] = None,
+                           warm: bool = False) -> Optional[CacheEmote]:
 
-            if img.is_animated:
-                return [img_bytes]
+        if media and media['size'] > EMOTE_SIZE_LIMIT and media['frames'] > 1:
+            logging.info(f'Skipped uploading {name}: too big for an emoji ({media["size"]} bytes)')
+            return
 
-            # Resize and pad with transparency
-            img.thumbnail((MAX_WIDTH, MIN_HEIGHT))
-            num_slices = round(img.size[0] / MIN_WIDTH)
+        image = await self.cache.images.get(url)
+        if not image:
+            return
 
-            # Skip padding for single-cell emotes, not worth it
-            if num_slices == 1:
-                with BytesIO() as io:
-                    img.save(io, 'PNG')
-                    io.seek(0)
-                    return [io.read()]
-            else:
-                cells = []
-                bg_width = MIN_WIDTH * num_slices
-                bg = Image.new('RGBA', (bg_width, MIN_HEIGHT), (255, 255, 255, 0))
-                bg.paste(img)
-
-                # Chop it up
-                for i in range(num_slices):
-                    left = i * MIN_WIDTH
-                    right = left + MIN_WIDTH
-                    bbox = (left, 0, right, MIN_HEIGHT)
-                    cell = img.crop(bbox)
-                    with BytesIO() as io:
-                        cell.save(io, 'PNG')
-                        io.seek(0)
-                        cells.append(io.read())
-
-                return cells
-
-    async def upload_emote(self, name: str, url: str) -> Optional[CacheEmote]:
-
-        async with self.session.get(url) as response:
-            if response.status != 200:
+        # Known animated or already small enough emotes go up as-is, without touching Pillow
+        probed = None
+        if media and (media['frames'] > 1 or (
+                media['ext'] == 'png' and media['width'] <= CHUNK_WIDTH and media['height'] <= CHUNK_HEIGHT)):
+            sliced_imgs = [image.data]
+        else:
+            try:
+                if media:
+                    sliced_imgs = await self.cache.preprocessor.run(preprocess_emote, image.data)
+                else:
+                    sliced_imgs, probed = await self.cache.preprocessor.run(preprocess_and_probe, image.data)
+            except PreprocessorBusy as e:
+                logging.warning(f'Skipped uploading {name}: {e}')
                 return
-            img = await response.read()
 
-        sliced_imgs = self.preprocess_emote(img)
+        # Only make room on the spot when the guild is truly full, normally the buffer gap absorbs new uploads
+        known = media or probed
+        animated = bool(known and known['frames'] > 1)
+        if self.free_slots(animated) < len(sliced_imgs):
+            await self.make_room()
 
-        upload_tasks = [
-            asyncio.create_task(self.guild.create_custom_emoji(
-                name=f"{name}_{i}", image=slice_)
-            )
+        priority = EmojiScheduler.BACKGROUND if warm else EmojiScheduler.USER
+        upload_futures = [
+            self.scheduler.create(f"{name}_{i}", slice_, priority)
             for i, slice_ in enumerate(sliced_imgs)
         ]
 
         big_emote = CacheEmote(name)
+        big_emote.media = probed
 
-        try:
-            uploaded = await asyncio.gather(*upload_tasks)
-        except discord.HTTPException:  # If one chunk fails to upload, cancel and undo the rest
-            for task in upload_tasks:
-                task.cancel()
-            for already_uploaded in big_emote.chunks:  # TODO: Single task for all of them?
-                asyncio.create_task(already_uploaded.delete())
-        else:
-            big_emote.chunks = uploaded
-            asyncio.create_task(self.ensure_space())
-            return big_emote
+        results = await asyncio.gather(*upload_futures, return_exceptions=True)
+        uploaded = [r for r in results if isinstance(r, discord.Emoji)]
+        if len(uploaded) < len(results):  # If one chunk fails to upload, undo the rest
+            for already_uploaded in uploaded:
+                self.scheduler.delete(already_uploaded)
+            return
 
-    async def ensure_space(self):
+        big_emote.chunks = uploaded
+        for chunk in uploaded:
+            self.index_chunk(chunk)
+        self.cache.record_upload(name)
+        asyncio.create_task(self.ensure_space())
+        return big_emote
+
+    async def make_room(self):
+        # A user upload cannot wait for deferred evictions
+        await asyncio.gather(*self.scheduler.expedite_deletes(), return_exceptions=True)
+        await self.ensure_space(EmojiScheduler.USER)
+
+    async def ensure_space(self, priority: int = EmojiScheduler.EVICT):
+
+        self.verify_index()
 
         static, animated = [], []
-        for emote in self.guild.emojis:
+        for emote in self.emojis:
             (static, animated)[emote.animated].append(emote)
 
         to_delete = set()
 
         for emote_list in [static, animated]:
-            excess_count = len(emote_list) - (self.max - self.BUFFER_SIZE)
+            excess_count = len(emote_list) - (self.max - self.cache.BUFFER_SIZE)
             if excess_count < 1:
                 continue
 
-            excess_emotes = sorted(emote_list, key=lambda e: e.created_at)[:excess_count]
+            excess_emotes = self.cache.eviction_order(emote_list)[:excess_count]
             for excess_emote in excess_emotes:
                 if excess_emote not in to_delete:
-                    big_emote = self.get_emote(excess_emote.name)
+                    big_emote = self.get_emote(split_chunk_name(excess_emote.name)[0])
                     if big_emote:
                         for chunk in big_emote.chunks:
                             to_delete.add(chunk)
 
-        delete_tasks = [asyncio.create_task(d.delete()) for d in to_delete]
-        await asyncio.gather(*delete_tasks)
+        for chunk in to_delete:
+            self.unindex_chunk(chunk)
+
+        await asyncio.gather(*[self.scheduler.delete(d, priority) for d in to_delete], return_exceptions=True)
 
     @property
     def used(self):
-        return len(self.guild.emojis)
+        return len(self.occupied)
 
     @property
     def max(self):
@@ -346,6 +1202,209 @@ class Cache:
     def free(self):
         return self.max - self.used
 
+    def free_slots(self, animated: bool) -> int:
+        return self.max - sum(1 for e in self.occupied if e.animated == animated)
+
+
+class Cache:
+    BUFFER_SIZE = 8
+    POLICIES = ('lru', 'lfu')
+    ADMISSIONS = ('tinylfu', 'always')
+    WARM_IDLE = 60  # seconds since the last user-driven upload before warming may start
+
+    def __init__(self, guilds: list, session, stats: StatsRecorder, preprocessor: Preprocessor,
+                 images: ImageCache, policy: str = 'lru', half_life: float = 24.0, admission: str = 'tinylfu',
+                 admit_threshold: int = 1):
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown eviction policy {policy}, expected one of {self.POLICIES}')
+        if admission not in self.ADMISSIONS:
+            raise ValueError(f'Unknown admission policy {admission}, expected one of {self.ADMISSIONS}')
+
+        self.session = session
+        self.stats = stats
+        self.preprocessor = preprocessor
+        self.images = images
+        self.policy = policy
+        self.half_life = half_life * 3600
+        self.admission = admission
+        self.admit_threshold = admit_threshold
+
+        self.usage: Dict[str, EmoteUsage] = {}
+        self.sketch = FrequencySketch()
+        self.admitted = 0
+        self.rejected = 0
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+
+        self.user_uploads = 0
+        self.last_user_upload = 0.0
+
+        self.uploads_in_flight = utils.SingleFlight()
+
+        self.shards: Dict[int, CacheShard] = {guild.id: CacheShard(self, guild) for guild in guilds}
+        self.ring = HashRing(list(self.shards))
+
+        asyncio.create_task(self.start())
+
+    async def start(self):
+        await self.load_usage()
+
+        # Ensure a BUFFER_SIZE gap between new insertions and deletions
+        await self.ensure_space()
+
+    async def load_usage(self):
+        async for doc in self.stats.collection.find({}, {'last_used': 1, 'score': 1, 'scored_at': 1}):
+            self.usage[doc['_id']] = EmoteUsage(
+                doc.get('last_used', 0.0), doc.get('score', 0.0), doc.get('scored_at', 0.0))
+
+    def record_use(self, name: str):
+        self.sketch.increment(name)
+        usage = self.usage.setdefault(name, EmoteUsage())
+        usage.hit(time.time(), self.half_life)
+        self.stats.set(name, last_used=usage.last_used, score=usage.score, scored_at=usage.scored_at)
+
+    def record_miss(self, name: str):
+        self.misses += 1
+        self.stats.increment(name, 'misses')
+        self.record_use(name)
+
+    def record_upload(self, name: str):
+        self.uploads += 1
+        self.stats.increment(name, 'uploads')
+
+    def admit(self, name: str, media: Optional[EmoteMedia] = None) -> bool:
+        # While there is room anything goes, after that it must be asked for more often than the eviction victim
+        shard = self.shard_for(name)
+        animated = bool(media and media['frames'] > 1)
+        if self.admission == 'always' or shard.free_slots(animated) > self.BUFFER_SIZE:
+            admitted = True
+        else:
+            freq = self.sketch.estimate(name)
+            candidates = [e for e in shard.emojis if e.animated == animated]
+            victim = self.eviction_order(candidates)[0] if candidates else None
+            admitted = freq >= self.admit_threshold and (
+                not victim or freq > self.sketch.estimate(split_chunk_name(victim.name)[0]))
+
+        if admitted:
+            self.admitted += 1
+        else:
+            self.rejected += 1
+            self.stats.increment(name, 'rejections')
+        return admitted
+
+    def priority(self, name: str, now: float) -> float:
+        # Lower priority emotes are evicted first
+        usage = self.usage.get(name)
+        if not usage:
+            return 0.0
+        if self.policy == 'lfu':
+            return usage.decayed_score(now, self.half_life)
+        return usage.last_used
+
+    def eviction_order(self, emojis: List[discord.Emoji]) -> List[discord.Emoji]:
+        now = time.time()
+        return sorted(emojis, key=lambda e: (self.priority(split_chunk_name(e.name)[0], now), e.created_at))
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def shard_for(self, name: str) -> CacheShard:
+        return self.shards[self.ring.get(name)]
+
+    def find_shard(self, name: str) -> Optional[CacheShard]:
+        # Differs from the hashed shard for emotes cached before the storage guild list changed
+        shard = self.shard_for(name)
+        if name in shard.index:
+            return shard
+        return next((s for s in self.shards.values() if name in s.index), None)
+
+    def on_emojis_update(self, guild, before: List[discord.Emoji], after: List[discord.Emoji]):
+        shard = self.shards.get(guild.id)
+        if shard:
+            shard.on_emojis_update(before, after)
+
+    def get_emote(self, name: str) -> Optional[CacheEmote]:
+        shard = self.find_shard(name)
+        if shard:
+            return shard.get_emote(name)
+
+    def use_emote(self, name: str) -> Optional[CacheEmote]:
+        # Unlike get_emote, counts towards the hit ratio and eviction policy
+        emote = self.get_emote(name)
+        if emote:
+            self.hits += 1
+            self.stats.increment(name, 'hits')
+            self.record_use(name)
+        return emote
+
+    async def delete_emote(self, name: str):
+        shard = self.find_shard(name)
+        if shard:
+            await shard.delete_emote(name)
+
+    async def purge(self):
+        for shard in self.shards.values():
+            await shard.purge()
+
+    async def upload_emote(self, name: str, url: str, media: Optional[EmoteMedia] = None,
+                           warm: bool = False) -> Optional[CacheEmote]:
+        # Pre-warmed emotes haven't been asked for, don't let them skew the stats
+        if not warm:
+            self.record_miss(name)
+            self.user_uploads += 1
+            self.last_user_upload = time.monotonic()
+        try:
+            return await self.upload_once(name, url, media, warm)
+        finally:
+            if not warm:
+                self.user_uploads -= 1
+
+    async def upload_once(self, name: str, url: str, media: Optional[EmoteMedia], warm: bool) -> Optional[CacheEmote]:
+        return await self.uploads_in_flight.run(
+            name, lambda: self.shard_for(name).upload_emote(name, url, media, warm=warm))
+
+    @property
+    def idle(self) -> bool:
+        return not self.user_uploads and time.monotonic() - self.last_user_upload > self.WARM_IDLE
+
+    def top_emotes(self, count: int) -> List[str]:
+        now = time.time()
+        return sorted(
+            self.usage, key=lambda name: self.usage[name].decayed_score(now, self.half_life), reverse=True)[:count]
+
+    def can_warm(self, doc: DatabaseEmote) -> bool:
+        # Warming must never evict, so it stays out of the BUFFER_SIZE gap
+        media = doc.get('media')
+        animated = media['frames'] > 1 if media else doc.get('animated', False)
+        needed = media['slices'] if media else MAX_CHUNKS
+        return self.shard_for(doc['_id']).free_slots(animated) - self.BUFFER_SIZE >= needed
+
+    async def ensure_space(self):
+        await asyncio.gather(*[shard.ensure_space() for shard in self.shards.values()])
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.scheduler.close()
+
+    @property
+    def emojis(self) -> List[discord.Emoji]:
+        return [e for shard in self.shards.values() for e in shard.emojis]
+
+    @property
+    def used(self):
+        return sum(shard.used for shard in self.shards.values())
+
+    @property
+    def max(self):
+        return sum(shard.max for shard in self.shards.values())
+
+    @property
+    def free(self):
+        return self.max - self.used
+
 
 class Emoter(commands.Cog):
 
@@ -353,23 +1412,157 @@ class Emoter(commands.Cog):
         self.session = bot.session
         self.emotes = bot.db['emoter.emotes']
         self.blacklist = bot.db['emoter.blacklist']
-        self.stats = bot.db['emoter.stats']
+        self.stats = StatsRecorder(bot.db['emoter.stats'])
         self.logs = bot.db['emoter.logs']
         self.cache: Optional[Cache] = None
-        self.db_updater = EmoteCollectionUpdater(self.emotes, self.logs, self.session)
+
+        # Every emote name in the database and every disabled one, so non-emote words never cost a query
+        self.known_emotes: Set[str] = set()
+        self.disabled_emotes: Set[str] = set()
+        self.names_loaded = False
+        self.random_emotes = utils.RandomDocs(self.emotes)
+
+        # Guild id -> its own emoji by name, these can be used as-is without taking a storage slot
+        self.guild_emojis: Dict[int, Dict[str, discord.Emoji]] = {}
+
+        self.preprocessor = Preprocessor(
+            executor=bot.cfg.get('emote_preprocess_executor', 'process'),
+            workers=bot.cfg.get('emote_preprocess_workers', 2),
+            max_queue=bot.cfg.get('emote_preprocess_queue', 16))
+        self.images = ImageCache(
+            self.session,
+            root=bot.cfg.get('emote_image_cache_dir', '.cache/emotes'),
+            max_bytes=bot.cfg.get('emote_image_cache_size', 256) * 1024 * 1024,
+            max_age=bot.cfg.get('emote_image_cache_ttl', 24) * 3600)
+        self.seventv_cache = utils.AsyncTTLCache(
+            ttl=bot.cfg.get('emote_7tv_ttl', 24) * 3600,
+            negative_ttl=bot.cfg.get('emote_7tv_negative_ttl', 1) * 3600)
+        self.db_updater = EmoteCollectionUpdater(
+            self.emotes, bot.db['emoter.emotes.staging'], self.logs, self.session, self.images)
         self.bot = bot
 
+    def cog_unload(self):
+        self.stats_flusher.cancel()
+        self.warmer.cancel()
+        self.preprocessor.shutdown()
+        self.images.flush()
+        asyncio.create_task(self.stats.flush())
+        if self.cache:
+            self.cache.close()
+
     @tasks.loop(hours=1.0)
     async def updater(self):
-        await self.db_updater.check_for_updates()
+        if await self.db_updater.check_for_updates():
+            await self.load_names()
+
+    async def load_names(self):
+        # The random picker needs every id anyway, so a single scan fills both
+        await self.random_emotes.reload()
+        known = set(self.random_emotes.ids)
+
+        disabled = set()
+        async for doc in self.blacklist.find({}, {'_id': 1}):
+            disabled.add(doc['_id'])
+
+        self.known_emotes, self.disabled_emotes = known, disabled
+        self.names_loaded = True
+
+    def may_be_emote(self, name: str) -> bool:
+        return not self.names_loaded or name in self.known_emotes
+
+    @tasks.loop(minutes=10.0)
+    async def warmer(self):
+        if self.cache and self.cache.idle:
+            await self.warm_cache()
+
+    async def warm_cache(self) -> int:
+        names = [
+            name for name in self.cache.top_emotes(self.bot.cfg.get('emote_warm_count', 50))
+            if name not in self.disabled_emotes and not self.cache.get_emote(name)
+        ]
+        if not names:
+            return 0
+
+        docs = {}
+        async for doc in self.emotes.find({'_id': {'$in': names}}):
+            docs[doc['_id']] = doc
+
+        warmed = 0
+        for name in names:
+            # Back off as soon as users need the cache
+            if not self.cache.idle:
+                break
+
+            doc = docs.get(name)
+            if not doc or self.cache.get_emote(name) or not self.cache.can_warm(doc):
+                continue
+
+            if await self.upload_emote(doc, warm=True):
+                warmed += 1
+
+            # Stay well clear of the emoji rate limits
+            await asyncio.sleep(self.bot.cfg.get('emote_warm_interval', 5))
+
+        if warmed:
+            logging.info(f'Pre-warmed {warmed} emotes')
+        return warmed
+
+    @tasks.loop(minutes=5.0)
+    async def stats_flusher(self):
+        try:
+            await self.stats.flush()
+        except PyMongoError as e:
+            logging.error(f'Could not flush emote stats, will retry: {e}')
 
     @commands.Cog.listener()
     async def on_ready(self):
-        emote_guild = self.bot.get_guild(self.bot.cfg['emote_storage_guild'])
-        if emote_guild:
-            self.cache = Cache(emote_guild, self.session)
+        storage_ids = self.bot.cfg.get('emote_storage_guilds') or [self.bot.cfg['emote_storage_guild']]
+        emote_guilds = [g for g in map(self.bot.get_guild, storage_ids) if g]
+        if emote_guilds and not self.cache:  # on_ready fires again after reconnects, keep the running cache
+            self.cache = Cache(
+                emote_guilds, self.session, self.stats, self.preprocessor, self.images,
+                policy=self.bot.cfg.get('emote_cache_policy', 'lru'),
+                half_life=self.bot.cfg.get('emote_cache_half_life', 24.0),
+                admission=self.bot.cfg.get('emote_cache_admission', 'tinylfu'),
+                admit_threshold=self.bot.cfg.get('emote_cache_admit_threshold', 1))
+
+        for guild in self.bot.guilds:
+            self.index_guild_emojis(guild, guild.emojis)
+
+        await self.load_names()
+
+        for loop in (self.updater, self.stats_flusher, self.warmer):
+            if not loop.is_running():
+                loop.start()
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        if self.cache:
+            self.cache.on_emojis_update(guild, before, after)
+        self.index_guild_emojis(guild, after)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self.index_guild_emojis(guild, guild.emojis)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.guild_emojis.pop(guild.id, None)
 
-        self.updater.start()
+    def index_guild_emojis(self, guild: discord.Guild, emojis: List[discord.Emoji]):
+        if self.cache and guild.id in self.cache.shards:
+            return  # Storage guilds are handled by the cache
+        self.guild_emojis[guild.id] = {e.name: e for e in emojis if e.available}
+
+    def find_native_emoji(self, message: Message, name: str) -> Optional[discord.Emoji]:
+        emoji = self.guild_emojis.get(message.guild.id, {}).get(name) if message.guild else None
+        if emoji or not self.bot.cfg.get('emote_shared_guild_emojis', False):
+            return emoji
+
+        for guild in message.author.mutual_guilds:
+            emoji = self.guild_emojis.get(guild.id, {}).get(name)
+            if emoji:
+                return emoji
 
     @commands.group()
     async def emoter(self, ctx):
@@ -388,13 +1581,13 @@ class Emoter(commands.Cog):
 
         if ctx.author.id == 232909513378758657:
             doc = await self.emotes.find_one({'_id': 'FeetPray'})
-            emote = await self.cache.upload_emote(doc['_id'], doc['url'])
+            emote = await self.upload_emote(doc)
             await ctx.respond(emote.to_string())
 
         else:
-            pipeline = [{'$sample': {'size': 1}}]
-            async for doc in self.emotes.aggregate(pipeline):
-                emote = await self.cache.upload_emote(doc['_id'], doc['url'])
+            doc = await self.random_emotes.pick(exclude=self.disabled_emotes)
+            if doc:
+                emote = await self.upload_emote(doc)
                 await ctx.respond(emote.to_string())
 
     @commands.max_concurrency(1)
@@ -407,24 +1600,84 @@ class Emoter(commands.Cog):
             await ctx.error(e)
         else:
             await ctx.success('Purged cache')
+            self.warmer.restart()
+
+    @commands.is_owner()
+    @emoter.command()
+    async def stats(self, ctx):
+        await self.stats.flush()
+
+        top = []
+        pipeline = [
+            {'$project': {'uses': {'$add': [{'$ifNull': ['$hits', 0]}, {'$ifNull': ['$misses', 0]}]},
+                          'uploads': {'$ifNull': ['$uploads', 0]}}},
+            {'$sort': {'uses': -1}},
+            {'$limit': 10}
+        ]
+        async for doc in self.stats.collection.aggregate(pipeline):
+            top.append(f'`{nomd(doc["_id"])}` {doc["uses"]} uses, {doc["uploads"]} uploads')
+
+        totals = {'hits': 0, 'misses': 0, 'uploads': 0}
+        pipeline = [{'$group': {'_id': None, **{k: {'$sum': f'${k}'} for k in totals}}}]
+        async for doc in self.stats.collection.aggregate(pipeline):
+            totals.update({k: doc[k] for k in totals})
+
+        requests = totals['hits'] + totals['misses']
+        embed = discord.Embed(color=0x8cc63e)
+        embed.add_field(inline=True, name='Hit ratio',
+                        value=f'{totals["hits"] / requests if requests else 0:.1%} ({totals["hits"]}/{requests})')
+        embed.add_field(inline=True, name='Uploads', value=f'{totals["uploads"]}')
+        if self.cache:
+            embed.add_field(inline=True, name='Since restart',
+                            value=f'{self.cache.hit_ratio:.1%} hit ratio, {self.cache.uploads} uploads')
+        embed.add_field(inline=False, name='Top emotes', value='\n'.join(top) or 'None')
+        await ctx.send(embed=embed)
 
     @commands.is_owner()
     @cache.command()
     async def info(self, ctx):
-        cached_emotes = ''.join(f'`{e.name}` ' for e in self.cache.guild.emojis)
+        cached_emotes = ''.join(f'`{e.name}` ' for e in self.cache.emojis)
         embed = discord.Embed(color=0x8cc63e)
         embed.add_field(inline=True, name='Capacity', value=f'{self.cache.used}/{self.cache.max}')
         embed.add_field(inline=True, name='Buffer size', value=f'{self.cache.BUFFER_SIZE}')
+        embed.add_field(inline=True, name='Storage guilds', value=' '.join(
+            f'`{shard.used}/{shard.max}, {shard.scheduler.depth} queued`' for shard in self.cache.shards.values()))
+        embed.add_field(inline=True, name='Rate limits', value=' '.join(
+            f'`{op} {bucket["throttled"]}/{bucket["calls"]} throttled`'
+            for shard in self.cache.shards.values() for op, bucket in shard.scheduler.buckets.items()))
+        embed.add_field(inline=True, name='Policy', value=self.cache.policy.upper())
+        embed.add_field(inline=True, name='Preprocessing', value=(
+            f'{self.preprocessor.pending}/{self.preprocessor.max_queue} queued, '
+            f'avg {self.preprocessor.avg_time * 1000:.0f}ms, max {self.preprocessor.max_time * 1000:.0f}ms'))
+        embed.add_field(inline=True, name='Hit ratio',
+                        value=f'{self.cache.hit_ratio:.1%} ({self.cache.hits}/{self.cache.hits + self.cache.misses})')
+        embed.add_field(inline=True, name='Uploads saved', value=f'{self.cache.uploads_in_flight.coalesced}')
+        embed.add_field(inline=True, name='Admission', value=(
+            f'{self.cache.admission.upper()}, {self.cache.admitted} admitted, {self.cache.rejected} rejected'))
         embed.add_field(inline=False, name='Cached', value=cached_emotes or 'None')
         await ctx.send(embed=embed)
 
     @emoter.command()
     async def add(self, ctx, name: str, url: str):
+        image = await self.images.get(url)
+        if not image:
+            await ctx.error('Could not download that image')
+            return
+
+        try:
+            media = await self.preprocessor.run(probe_media, image.data)
+        except Exception:
+            await ctx.error('That does not look like an image')
+            return
+
         try:
-            await self.emotes.insert_one(DatabaseEmote(_id=name, url=url, src=ctx.author.id))
+            await self.emotes.insert_one(DatabaseEmote(
+                _id=name, url=url, src=ctx.author.id, animated=media['frames'] > 1, media=media))
         except DuplicateKeyError:
             await ctx.info(f'Emote already exists')
         else:
+            self.known_emotes.add(name)
+            self.random_emotes.add(name)
             await ctx.success(f"Added emote `${name}`")
 
     @commands.max_concurrency(1)
@@ -434,6 +1687,7 @@ class Emoter(commands.Cog):
         try:
             await ctx.info('Forcing emote database update ...')
             await self.db_updater.update()
+            await self.load_names()
         except Exception as e:
             await ctx.error(e)
         else:
@@ -447,6 +1701,7 @@ class Emoter(commands.Cog):
         except DuplicateKeyError:
             await ctx.info(f'Emote `{nomd(emote_name)} already disabled')
         else:
+            self.disabled_emotes.add(emote_name)
             await ctx.success(f'Emote `{nomd(emote_name)}` disabled')
 
     @commands.is_owner()
@@ -467,6 +1722,7 @@ class Emoter(commands.Cog):
         except Exception as e:
             await ctx.error(e)
         else:
+            self.disabled_emotes.discard(emote_name)
             if result.deleted_count:
                 await ctx.success(f'Emote `{nomd(emote_name)}` enabled')
             else:
@@ -475,6 +1731,9 @@ class Emoter(commands.Cog):
     @emoter.command()
     async def remove(self, ctx, name):
         doc = await self.emotes.find_one_and_delete({'_id': name, 'src': ctx.author.id})
+        if doc:
+            self.known_emotes.discard(name)
+            self.random_emotes.discard(name)
         await ctx.success(f'Deleted emote `${name}`' if doc else 'Emote not found or you are not the owner')
 
     @commands.Cog.listener()
@@ -486,99 +1745,153 @@ class Emoter(commands.Cog):
 
         content = message.content
 
-        single_emote = True
-        prefixed = []
-        words = content.split()
-
-        for word in words:
-            if word.startswith('$'):
-                prefixed.append(word[1:])
-            else:
-                single_emote = False
+        spans = find_emotes(content)
+        if not spans:
+            return
 
-        num_prefixed = len(prefixed)
-        if num_prefixed == 0:
+        prefixed = [name for name in dict.fromkeys(name for _, _, name in spans) if name not in self.disabled_emotes]
+        if not prefixed:
             return
 
         # if the message is nothing but an emoji, we can cut some corners
         # TODO: Resize if taller than 48px, handle extension properly (.gif seems to work for all)
-        if num_prefixed == 1 and single_emote:
+        start, end, _ = spans[0]
+        if len(spans) == 1 and content[start:end] == content.strip():
+
+            # the guild's own emoji cost nothing, then do the cache lookup as normal
+            native = self.find_native_emoji(message, prefixed[0])
+            if native:
+                await self.send_as_user(message, str(native), None)
+                await message.delete()
+                return
 
-            # first do the cache lookup as normal
-            big_emote = self.cache.get_emote(prefixed[0])
+            big_emote = self.cache.use_emote(prefixed[0])
             if big_emote:
                 await self.send_as_user(message, big_emote.to_string(), None)
                 await message.delete()
                 return
             # else we dont have to upload anything, we can just send as an attachment
             else:
-                doc = await self.emotes.find_one({'_id': prefixed[0]})
+                doc = await self.emotes.find_one({'_id': prefixed[0]}) if self.may_be_emote(prefixed[0]) else None
                 if doc:
                     url = doc['url']
                 else:
                     url = await self.query_7tv_emote(prefixed[0])
-                if url:
-                    url_resp = await self.session.get(url)
-                    data = await url_resp.read()
-                    ext = {url_resp.headers["Content-Type"].split("/")[1]}
-                    await self.send_as_user(message, None, discord.File(BytesIO(data), f'{prefixed[0]}.{ext}'))
+                image = await self.images.get(url) if url else None
+                if image:
+                    self.cache.record_miss(prefixed[0])
+                    media = doc.get('media') if doc else None
+                    if media:
+                        ext = media['ext']
+                    else:
+                        ext = image.content_type.split('/')[-1] or 'png'
+                        if doc:
+                            asyncio.create_task(self.probe_and_save_media(doc, image.data))
+                    await self.send_as_user(message, None, discord.File(BytesIO(image.data), f'{prefixed[0]}.{ext}'))
                     await message.delete()
                     return
 
         replacements = {}
         search_in_db = []
+        file = None
 
-        # Search for words in emote cache
+        # Search for words in the guild's own emoji, then the emote cache
         for word in prefixed:
-            big_emote = self.cache.get_emote(word)
+            native = self.find_native_emoji(message, word)
+            if native:
+                replacements[word] = str(native)
+                continue
+
+            big_emote = self.cache.use_emote(word)
             if big_emote:
                 replacements[word] = big_emote.to_string()
             else:
                 search_in_db.append(word)
 
         # Search remaining words in database
+        search_in_db = [word for word in search_in_db if self.may_be_emote(word)]
         if search_in_db:
-            upload_tasks = []
-            async for doc in self.emotes.find({'_id': {'$in': search_in_db}}):
-                upload_task = asyncio.create_task(self.cache.upload_emote(doc['_id'], doc['url']))
-                upload_tasks.append(upload_task)
+            docs = [doc async for doc in self.emotes.find({'_id': {'$in': search_in_db}})]
+            docs.sort(key=lambda d: prefixed.index(d['_id']))
 
-            big_emotes = await asyncio.gather(*upload_tasks)
-            for big_emote in big_emotes:
-                replacements[big_emote.name] = big_emote.to_string()
+            # Emotes not worth a storage slot, or too many uploads for one message, go out as a single image
+            admitted = [doc for doc in docs if self.cache.admit(doc['_id'], doc.get('media'))]
+            if self.uploads_needed(admitted) > self.bot.cfg.get('emote_composite_threshold', 4):
+                to_composite = docs
+            else:
+                to_composite = [doc for doc in docs if doc not in admitted]
+
+            composited = await self.render_composite(to_composite) if to_composite else None
+            if composited:
+                names, img_bytes = composited
+                for name in names:
+                    replacements[name] = ''
+                file = discord.File(BytesIO(img_bytes), 'emotes.png')
+                docs = [doc for doc in docs if doc['_id'] not in names]
+
+            if docs:
+                upload_tasks = [asyncio.create_task(self.upload_emote(doc)) for doc in docs]
+                big_emotes = await asyncio.gather(*upload_tasks)
+                for big_emote in big_emotes:
+                    if big_emote:
+                        replacements[big_emote.name] = big_emote.to_string()
 
-        # If there are still words left, search for them in the database
         if not replacements:
             return
 
-        # TODO: Sort keys by length so as to prevent substring replacement infighting
-
-        for word, replacement in replacements.items():
-            content = content.replace(f'${word}', replacement)
+        content = replace_emotes(content, spans, replacements).strip() or None
 
         try:
-            await self.send_as_user(message, content, None)
+            await self.send_as_user(message, content, file)
         except Exception as e:
             logging.warning(e)
         else:
             await message.delete()
 
-    async def send_as_user(self, msg: Message, content: Optional[str], file: Optional[File]) -> Optional[
-        WebhookMessage]:
+    @staticmethod
+    def uploads_needed(docs: List[DatabaseEmote]) -> int:
+        return sum(doc['media']['slices'] if doc.get('media') else 1 for doc in docs)
+
+    async def render_composite(self, docs: List[DatabaseEmote]) -> Optional[Tuple[List[str], bytes]]:
+        images = await asyncio.gather(*[self.images.get(doc['url']) for doc in docs])
+        found = [(doc['_id'], image.data) for doc, image in zip(docs, images) if image]
+        if not found:
+            return None
 
-        is_thread = isinstance(msg.channel, Thread)
-        if is_thread:
-            channel = msg.channel.parent
+        try:
+            img_bytes = await self.preprocessor.run(composite_emotes, [data for _, data in found])
+        except Exception as e:
+            logging.warning(f'Could not composite emotes: {e}')
+            return None
+
+        names = [name for name, _ in found]
+        for name in names:
+            self.cache.record_miss(name)
+        return names, img_bytes
+
+    async def upload_emote(self, doc: DatabaseEmote, warm: bool = False) -> Optional[CacheEmote]:
+        big_emote = await self.cache.upload_emote(doc['_id'], doc['url'], doc.get('media'), warm=warm)
+        if big_emote and big_emote.media and not doc.get('media'):
+            await self.save_media(doc, big_emote.media)
+        return big_emote
+
+    async def save_media(self, doc: DatabaseEmote, media: EmoteMedia):
+        await self.emotes.update_one({'_id': doc['_id'], 'url': doc['url']}, {'$set': {'media': media}})
+
+    async def probe_and_save_media(self, doc: DatabaseEmote, img_bytes: bytes):
+        try:
+            media = await self.preprocessor.run(probe_media, img_bytes)
+        except Exception as e:
+            logging.warning(f'Could not probe {doc["_id"]}: {e}')
         else:
-            channel = msg.channel
+            await self.save_media(doc, media)
 
-        webhooks = await channel.webhooks()
-        webhook: Webhook = discord.utils.find(lambda m: m.user.id == self.bot.user.id, webhooks)
-        if not webhook:
-            try:
-                webhook = await channel.create_webhook(name='NBot')
-            except (HTTPException, Forbidden):
-                return None
+    async def send_as_user(self, msg: Message, content: Optional[str], file: Optional[File]) -> Optional[
+        WebhookMessage]:
+
+        utils_cog = self.bot.get_cog('Utils')
+        if not utils_cog:
+            return None
 
         args = {
             'username': msg.author.display_name.ljust(2, INVISIBLE_CHAR),
@@ -591,12 +1904,12 @@ class Emoter(commands.Cog):
         if file:
             args['file'] = file
 
-        if is_thread:
-            args['thread'] = msg.channel
+        return await utils_cog.send_with_webhook(msg.channel, **args)
 
-        await webhook.send(**args)
+    async def query_7tv_emote(self, keyword: str) -> Optional[str]:
+        return await self.seventv_cache.get(keyword, self.fetch_7tv_emote)
 
-    async def query_7tv_emote(self, keyword) -> Optional[str]:
+    async def fetch_7tv_emote(self, keyword: str) -> Optional[str]:
 
         async with self.session.post('https://api.7tv.app/v2/gql', json={
             'query': 'query($query: String!,$page: Int,$pageSize: Int,$globalState: String,$sortBy: String,'
@@ -619,17 +1932,26 @@ class Emoter(commands.Cog):
             # return the response
             gql_json = await gql_response.json()
 
-            emote_name = gql_json['data']['search_emotes'][0]['name']
-            if emote_name.lower() != keyword.lower():
+            results = (gql_json.get('data') or {}).get('search_emotes')
+            if not results:
                 return None
 
-            # get the emote id
-            emote_id = gql_json['data']['search_emotes'][0]['id']
-            print(emote_id)
+            emote_name = results[0]['name']
+            if emote_name.lower() != keyword.lower():
+                return None
 
             # create a request to get the emote
-            emote_url = f'https://cdn.7tv.app/emote/{emote_id}/2x'
-            return emote_url
+            emote_url = f'https://cdn.7tv.app/emote/{results[0]["id"]}/2x'
+
+        if self.bot.cfg.get('emote_7tv_writeback', True):
+            try:
+                await self.emotes.insert_one(DatabaseEmote(_id=emote_name, url=emote_url, src='7tv'))
+            except DuplicateKeyError:
+                pass
+            self.known_emotes.add(emote_name)
+            self.random_emotes.add(emote_name)
+
+        return emote_url
 
 
 def setup(bot):
@@ -1,15 +1,337 @@
+import asyncio
+import re
+import struct
+import sys
+import time
+import tracemalloc
 import zlib
-from io import StringIO
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple, List, Set, Any
 
+import discord
 from discord import TextChannel, User
 from discord.ext import commands
-from markovify import NewlineText
-from motor import motor_asyncio
+import markovify
+from markovify import NewlineText, Chain
+from markovify.chain import BEGIN, END
+from motor.motor_asyncio import AsyncIOMotorCollection
 
 from cogs import utils
 
 MAX_NAME_LENGTH = 32
 
+STATE_SIZE = 2
+LINK_ONLY = re.compile(r'^(?:<?https?://\S+>?\s*)+$')
+
+MODEL_MAGIC = b'MKV'
+MODEL_VERSION = 1
+MODEL_HEADER = struct.Struct('<BI')  # state size, token table bytes
+MODEL_SECTION = struct.Struct('<cI')  # array typecode, item count
+
+
+def estimate_model_size(model: NewlineText) -> int:
+    # Token strings are mostly shared between states, so they are only counted through the sentences
+    chain = model.chain.model
+    size = sys.getsizeof(chain)
+    for state, options in chain.items():
+        size += sys.getsizeof(state) + sys.getsizeof(options)
+
+    for sentence in getattr(model, 'parsed_sentences', None) or []:
+        size += sys.getsizeof(sentence) + sum(sys.getsizeof(word) for word in sentence)
+    size += sys.getsizeof(getattr(model, 'rejoined_text', ''))
+    return size
+
+
+def pack_ints(values: List[int]) -> array:
+    # Narrowest unsigned type that fits, always stored little-endian
+    largest = max(values, default=0)
+    packed = array(next(code for code in 'BHI' if largest < 1 << (array(code).itemsize * 8)), values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed
+
+
+def pack_model(model: NewlineText) -> bytes:
+    # Tokens never contain whitespace, so the token table is newline separated
+    tokens: Dict[str, int] = {}
+
+    def token_id(word: str) -> int:
+        return tokens.setdefault(word, len(tokens))
+
+    states, fanouts, nexts, counts = [], [], [], []
+    for state, options in model.chain.model.items():
+        states.extend(token_id(word) for word in state)
+        fanouts.append(len(options))
+        for word, count in options.items():
+            nexts.append(token_id(word))
+            counts.append(count)
+
+    lengths, words = [], []
+    for sentence in getattr(model, 'parsed_sentences', None) or []:
+        lengths.append(len(sentence))
+        words.extend(token_id(word) for word in sentence)
+
+    token_table = '\n'.join(tokens).encode('utf-8')
+    sections = [pack_ints(values) for values in (states, fanouts, nexts, counts, lengths, words)]
+
+    payload = [MODEL_HEADER.pack(model.state_size, len(token_table))]
+    payload += [MODEL_SECTION.pack(section.typecode.encode(), len(section)) for section in sections]
+    payload += [token_table] + [section.tobytes() for section in sections]
+    return MODEL_MAGIC + bytes([MODEL_VERSION]) + zlib.compress(b''.join(payload))
+
+
+def unpack_model(packed: bytes) -> NewlineText:
+    if not packed.startswith(MODEL_MAGIC):  # Zlib-compressed JSON from before the binary format
+        return NewlineText.from_json(zlib.decompress(packed))
+
+    version = packed[len(MODEL_MAGIC)]
+    if version != MODEL_VERSION:
+        raise ValueError(f'Unknown model format version {version}')
+
+    payload = memoryview(zlib.decompress(packed[len(MODEL_MAGIC) + 1:]))
+    state_size, table_size = MODEL_HEADER.unpack_from(payload)
+    offset = MODEL_HEADER.size
+
+    layout = []
+    for _ in range(6):
+        layout.append(MODEL_SECTION.unpack_from(payload, offset))
+        offset += MODEL_SECTION.size
+
+    tokens = str(payload[offset:offset + table_size], 'utf-8').split('\n')
+    offset += table_size
+
+    sections = []
+    for typecode, count in layout:
+        section = array(typecode.decode())
+        size = count * section.itemsize
+        section.frombytes(payload[offset:offset + size])
+        if sys.byteorder == 'big':
+            section.byteswap()
+        sections.append(section)
+        offset += size
+    states, fanouts, nexts, counts, lengths, words = sections
+
+    # Every occurrence of a word points to the same string object from the table
+    lookup = tokens.__getitem__
+    chain = {}
+    pos = 0
+    for i, fanout in enumerate(fanouts):
+        state = tuple(map(lookup, states[i * state_size:(i + 1) * state_size]))
+        chain[state] = dict(zip(map(lookup, nexts[pos:pos + fanout]), counts[pos:pos + fanout]))
+        pos += fanout
+
+    parsed_sentences = []
+    pos = 0
+    for length in lengths:
+        parsed_sentences.append(list(map(lookup, words[pos:pos + length])))
+        pos += length
+
+    return NewlineText(None, state_size=state_size, chain=Chain(None, state_size, chain),
+                       parsed_sentences=parsed_sentences)
+
+
+def load_model(packed: bytes) -> Tuple[NewlineText, int]:
+    # Sized here in the worker, walking a big model takes long enough to stall the event loop
+    model = unpack_model(packed)
+    return model, estimate_model_size(model)
+
+
+def traced(enabled: bool, func, *args) -> Tuple[Any, Optional[int]]:
+    # Pool workers outlive their jobs, so peak memory is measured per call
+    if not enabled:
+        return func(*args), None
+
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def model_from_messages(messages: List[str]) -> Optional[NewlineText]:
+    # Never joins the messages into one corpus string the way NewlineText(text) does
+    parsed_sentences = [
+        sentence.split()
+        for message in reversed(messages)
+        for sentence in message.splitlines() if sentence.strip()
+    ]
+    if not parsed_sentences:
+        return None
+
+    chain = Chain(parsed_sentences, STATE_SIZE)
+    return NewlineText(None, state_size=STATE_SIZE, chain=chain, parsed_sentences=parsed_sentences)
+
+
+def build_model(messages: List[str],
+                trace: bool = False) -> Tuple[Optional[NewlineText], Optional[bytes], int, Optional[int]]:
+
+    def build():
+        model = model_from_messages(messages)
+        if not model:
+            return None, None, 0
+        return model, pack_model(model), estimate_model_size(model)
+
+    (model, packed, size), peak = traced(trace, build)
+    return model, packed, size, peak
+
+
+def trim_model(model: NewlineText, max_chars: int) -> NewlineText:
+    # Sentences are kept oldest first and the chain counts exactly those, so dropped ones can be subtracted back out
+    sentences = model.parsed_sentences
+    total = sum(len(word) + 1 for sentence in sentences for word in sentence)
+
+    drop = 0
+    while total > max_chars and drop < len(sentences) - 1:
+        total -= sum(len(word) + 1 for word in sentences[drop])
+        drop += 1
+    if not drop:
+        return model
+
+    state_size = model.state_size
+    chain = model.chain.model
+    for sentence in sentences[:drop]:
+        items = [BEGIN] * state_size + sentence + [END]
+        for i in range(len(sentence) + 1):
+            state = tuple(items[i:i + state_size])
+            options = chain[state]
+            follow = items[i + state_size]
+            options[follow] -= 1
+            if not options[follow]:
+                del options[follow]
+                if not options:
+                    del chain[state]
+
+    return NewlineText(None, state_size=state_size, chain=Chain(None, state_size, chain),
+                       parsed_sentences=sentences[drop:])
+
+
+def merge_model(packed: bytes, messages: List[str], max_chars: int, return_model: bool,
+                trace: bool = False) -> Tuple[Optional[NewlineText], Optional[bytes], int, Optional[int]]:
+    # The model is costly to ship back from the pool, so it only comes back when asked for
+
+    def merge():
+        update = model_from_messages(messages)
+        if not update:
+            return None, None
+
+        merged = trim_model(markovify.combine([unpack_model(packed), update]), max_chars)
+        return merged, pack_model(merged)
+
+    (merged, merged_packed), peak = traced(trace, merge)
+    if not return_model or not merged:
+        return None, merged_packed, 0, peak
+    return merged, merged_packed, estimate_model_size(merged), peak
+
+
+class CorpusBuilder:
+
+    def __init__(self, history: AsyncIOMotorCollection, ignored_prefixes: List[str], max_chars: int,
+                 batch_size: int = 1000):
+        self.history = history
+        self.ignored_prefixes = tuple(ignored_prefixes)
+        self.max_chars = max_chars
+        self.batch_size = batch_size
+
+    def accept(self, msg: str) -> bool:
+        msg = msg.strip()
+        return bool(msg) and not msg.startswith(self.ignored_prefixes) and not LINK_ONLY.match(msg)
+
+    async def collect(self, query: dict) -> Tuple[List[str], int, int]:
+        # Kept messages come back newest first, along with the newest id seen and how many were read
+        cursor = self.history.find(query, {'msg': 1}).sort('_id', -1).batch_size(self.batch_size)
+
+        messages = []
+        chars = 0
+        read = 0
+        last_id = 0
+        async for doc in cursor:
+            read += 1
+            last_id = max(last_id, doc['_id'])
+            if not self.accept(doc['msg']):
+                continue
+
+            messages.append(doc['msg'])
+            chars += len(doc['msg'])
+            if chars >= self.max_chars:
+                break
+
+        return messages, last_id, read
+
+
+def generate_sentences(model: NewlineText, start_words: str, count: int, deadline: float,
+                       tries: int = 100) -> List[str]:
+    # Worker threads cannot be cancelled from outside, so give up on our own at the deadline
+    sentences = []
+    for _ in range(count):
+        for _ in range(0, tries, 10):
+            if time.monotonic() > deadline:
+                return sentences
+
+            if start_words:
+                sentence = model.make_sentence_with_start(start_words, strict=False, tries=10)
+            else:
+                sentence = model.make_sentence(tries=10)
+            if sentence:
+                sentences.append(sentence)
+                break
+
+    return sentences
+
+
+class ModelCache:
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+
+        # User id -> (model, estimated size), least recently used first
+        self.entries: 'OrderedDict[int, Tuple[NewlineText, int]]' = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.entries
+
+    def get(self, user_id: int) -> Optional[NewlineText]:
+        entry = self.entries.get(user_id)
+        if not entry:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(user_id)
+        return entry[0]
+
+    def put(self, user_id: int, model: NewlineText, size: int):
+        self.invalidate(user_id)
+
+        if size > self.max_bytes:
+            return
+
+        self.entries[user_id] = (model, size)
+        self.resident_bytes += size
+        while self.resident_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.resident_bytes -= evicted_size
+
+    def invalidate(self, user_id: int):
+        entry = self.entries.pop(user_id, None)
+        if entry:
+            self.resident_bytes -= entry[1]
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
 
 class Parrot(commands.Cog, name="Parrot"):
 
@@ -17,6 +339,33 @@ class Parrot(commands.Cog, name="Parrot"):
         self.bot = bot
         self.models = bot.db['markov_models']
         self.history = bot.db['chat_archive']
+        self.model_cache = ModelCache(bot.cfg.get('parrot_model_cache_size', 256) * 1024 * 1024)
+        self.pool = ProcessPoolExecutor(max_workers=bot.cfg.get('parrot_workers', 2))
+        self.build_timeout = bot.cfg.get('parrot_build_timeout', 120)
+        self.generate_timeout = bot.cfg.get('parrot_generate_timeout', 10)
+        self.trace_memory = bot.cfg.get('parrot_trace_memory', False)
+
+        self.corpus = CorpusBuilder(
+            self.history,
+            ignored_prefixes=bot.cfg.get('parrot_ignored_prefixes') or [bot.cfg['bot-prefix']],
+            max_chars=bot.cfg.get('parrot_corpus_max_chars', 2_000_000),
+            batch_size=bot.cfg.get('parrot_corpus_batch', 1000))
+
+        # User id -> model build in progress, so concurrent requests share it
+        self.building = utils.SingleFlight()
+
+    def cog_unload(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Lets corpus reads walk a user's messages newest first without sorting them
+        await self.history.create_index([('author', 1), ('_id', -1)])
+
+    async def run_in_pool(self, func, *args, timeout: float):
+        # On timeout a job that already started is left to finish in the background
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.pool, func, *args), timeout)
 
     @commands.command(aliases=["b", "be", "imp"])
     async def parrot(self, ctx, name, start_words=""):
@@ -25,70 +374,119 @@ class Parrot(commands.Cog, name="Parrot"):
         if not user:
             return
 
-        model = await self.fetch_user_model(user.id)
-        if not model:
-            await ctx.send(f'Generating speech model for {user.display_name}..')
-            model = await self.create_model_for_user(user.id)
+        try:
+            model = await self.fetch_user_model(user.id)
             if not model:
-                await ctx.send('Apologies but something is fucked')
-                return
+                await ctx.send(f'Generating speech model for {user.display_name}..')
+                model = await self.create_model_for_user(user.id)
+                if not model:
+                    await ctx.send('Apologies but something is fucked')
+                    return
 
-        for i in range(3):
+            deadline = time.monotonic() + self.generate_timeout
+            sentences = await asyncio.wait_for(
+                asyncio.to_thread(generate_sentences, model, start_words, 3, deadline), self.generate_timeout + 1)
+        except asyncio.TimeoutError:
+            await ctx.send(f'Took too long to come up with something for {user.display_name}')
+            return
 
-            if len(start_words) > 0:
-                sentence = model.make_sentence_with_start(start_words, strict=False)
-            else:
-                sentence = model.make_sentence(tries=100)
-            if sentence:
-                await self.parrot_user(user, ctx.channel, sentence)
+        for sentence in sentences:
+            await self.parrot_user(user, ctx.channel, sentence)
+
+    @commands.is_owner()
+    @commands.command()
+    async def parrotcache(self, ctx):
+        cache = self.model_cache
+        embed = discord.Embed(color=0x8cc63e)
+        embed.add_field(inline=True, name='Models', value=f'{len(cache)}')
+        embed.add_field(inline=True, name='Memory',
+                        value=f'{cache.resident_bytes / 1024 / 1024:.1f}/{cache.max_bytes / 1024 / 1024:.0f} MB')
+        embed.add_field(inline=True, name='Hit ratio',
+                        value=f'{cache.hit_ratio:.1%} ({cache.hits}/{cache.hits + cache.misses})')
+        await ctx.send(embed=embed)
 
     async def fetch_user_model(self, user_id: int):
+        model = self.model_cache.get(user_id)
+        if model:
+            return model
+
         result = await self.models.find_one({'_id': user_id}, {'msg': 1})
         if result:
-            return NewlineText.from_json(zlib.decompress(result['msg']))
+            model, size = await self.run_in_pool(load_model, result['msg'], timeout=self.build_timeout)
+            self.model_cache.put(user_id, model, size)
+            return model
 
-    async def save_user_model(self, user_id: int, model):
-        packed_model = zlib.compress(model.to_json().encode('utf-8'), level=9)
-        await self.models.update_one(
-            {'_id': user_id},
-            {'$set': {'msg': packed_model}},
-            upsert=True)
+    async def save_user_model(self, user_id: int, model: Optional[NewlineText], model_size: int,
+                              packed_model: Optional[bytes], last_id: int):
+        # last_id is the newest archived message the model has seen
+        update = {'last_id': last_id}
+        if packed_model:
+            update['msg'] = packed_model
 
-    async def create_model_for_user(self, user_id: int):
-        results = self.history.find({'author': user_id}, {'msg': 1})
+        await self.models.update_one({'_id': user_id}, {'$set': update}, upsert=True)
+        if model:
+            self.model_cache.put(user_id, model, model_size)
+        elif packed_model:
+            self.model_cache.invalidate(user_id)
 
-        f = StringIO()
-        async for doc in results:
-            f.write(doc['msg'])
-            f.write('\n')
+    async def create_model_for_user(self, user_id: int) -> Optional[NewlineText]:
+        return await self.building.run(user_id, lambda: self.build_model_for_user(user_id))
 
-        model = NewlineText(f.getvalue(), well_formed=False)
-        if model:
-            await self.save_user_model(user_id, model)
-            return model
+    async def build_model_for_user(self, user_id: int) -> Optional[NewlineText]:
+        messages, last_id, read = await self.corpus.collect({'author': user_id})
+        if not messages:
+            return None
+
+        model, packed_model, size, peak = await self.run_in_pool(
+            build_model, messages, self.trace_memory, timeout=self.build_timeout)
+
+        stats = f'{len(messages)}/{read} messages, {sum(map(len, messages))} chars'
+        if peak is not None:
+            stats += f', peak memory {peak / 1024 / 1024:.0f} MB'
+        print(f'Built speech model for {user_id} from {stats}')
+        if not model:
+            return None
+
+        await self.save_user_model(user_id, model, size, packed_model, last_id)
+        return model
 
-    @staticmethod
-    async def create_corpus_from_message_history(messages: motor_asyncio.AsyncIOMotorCursor):
-        f = StringIO()
-        async for doc in messages:
-            f.write(doc['msg'])
-            f.write('\n')
-        return f.getvalue()
+    async def update_model_for_user(self, user_id: int, packed_model: bytes, last_id: int):
+        # Only cached models are refreshed there, so a batch of updates does not flush out the ones in use
+        messages, newest_id, _ = await self.corpus.collect({'author': user_id, '_id': {'$gt': last_id}})
+
+        model, size, merged_model = None, 0, None
+        if messages:
+            model, merged_model, size, _ = await self.run_in_pool(
+                merge_model, packed_model, messages, self.corpus.max_chars, user_id in self.model_cache,
+                self.trace_memory, timeout=self.build_timeout)
+
+        await self.save_user_model(user_id, model, size, merged_model, max(last_id, newest_id))
+
+    @commands.Cog.listener()
+    async def on_chat_archived(self, authors: Set[int]):
+        async for doc in self.models.find({'_id': {'$in': list(authors)}}):
+            user_id = doc['_id']
+            if user_id in self.building:
+                continue  # Being built from scratch right now, which already includes the new messages
+
+            try:
+                if 'last_id' in doc:
+                    await self.update_model_for_user(user_id, doc['msg'], doc['last_id'])
+                else:  # Models from before high-water marks were tracked need one last full rebuild
+                    await self.create_model_for_user(user_id)
+            except Exception as e:
+                print(f'Could not update speech model for {user_id}: {e}')
 
     async def parrot_user(self, user: User, channel: TextChannel, content: str):
         utils_cog = self.bot.get_cog('Utils')
         if not utils_cog:
             return
 
-        webhook = await utils_cog.get_webhook_for_channel(channel)
-        if not webhook:
-            return
-
         suffix = ' Simulator'
         maxlen = MAX_NAME_LENGTH - len(suffix)
         username = utils.truncate_string(user.display_name, maxlen) + suffix
 
-        await webhook.send(username=username, content=content, avatar_url=user.display_avatar)
+        await utils_cog.send_with_webhook(channel, username=username, content=content, avatar_url=user.display_avatar)
 
 
 def setup(bot):
@@ -1,6 +1,13 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Union, Callable, Awaitable, Any, Hashable, List, Container
+
 import discord
-from discord import TextChannel
+from discord import TextChannel, Thread, Webhook, WebhookMessage, HTTPException, Forbidden, NotFound
 from discord.ext import commands
+from motor.motor_asyncio import AsyncIOMotorCollection
 
 
 class Utils(commands.Cog):
@@ -8,15 +15,204 @@ class Utils(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+        # Channel id -> our webhook in it, shared by every cog that posts as other users
+        self.webhooks: Dict[int, Webhook] = {}
+        self.webhook_locks: Dict[int, asyncio.Lock] = {}
+
+    @staticmethod
+    def webhook_channel(channel: Union[TextChannel, Thread]) -> TextChannel:
+        return channel.parent if isinstance(channel, Thread) else channel
+
     @commands.bot_has_permissions(manage_webhooks=True)
-    async def get_webhook_for_channel(self, channel: TextChannel):
-        webhooks = await channel.webhooks()
+    async def get_webhook_for_channel(self, channel: Union[TextChannel, Thread]) -> Optional[Webhook]:
+        channel = self.webhook_channel(channel)
+        webhook = self.webhooks.get(channel.id)
+        if webhook:
+            return webhook
+
+        # Serialize resolution per channel so a burst of messages can't create duplicate webhooks
+        async with self.webhook_locks.setdefault(channel.id, asyncio.Lock()):
+            webhook = self.webhooks.get(channel.id)
+            if webhook:
+                return webhook
+
+            try:
+                webhooks = await channel.webhooks()
+                webhook = next((w for w in webhooks if w.user == self.bot.user), None)
+                if not webhook:
+                    webhook = await channel.create_webhook(name='NBot')
+            except (HTTPException, Forbidden):
+                return None
+
+            self.webhooks[channel.id] = webhook
+            return webhook
+
+    def invalidate_webhook(self, channel: Union[TextChannel, Thread]):
+        self.webhooks.pop(self.webhook_channel(channel).id, None)
+
+    async def send_with_webhook(self, channel: Union[TextChannel, Thread], **kwargs) -> Optional[WebhookMessage]:
+        if isinstance(channel, Thread):
+            kwargs['thread'] = channel
+
+        webhook = await self.get_webhook_for_channel(channel)
+        if not webhook:
+            return None
+
         try:
-            webhook = next(w for w in webhooks if w.user == self.bot.user)
-        except StopIteration:
-            webhook = await channel.create_webhook(name='NBot')
+            return await webhook.send(**kwargs)
+        except NotFound:  # Webhook was deleted behind our back, resolve it again once
+            self.invalidate_webhook(channel)
+            webhook = await self.get_webhook_for_channel(channel)
+            if webhook:
+                return await webhook.send(**kwargs)
+
+    @commands.Cog.listener()
+    async def on_webhooks_update(self, channel):
+        self.invalidate_webhook(channel)
+
+
+class SingleFlight:
+    """Concurrent calls for the same key all await the first one, sharing its result or failure.
+    If that first call gets cancelled, the next waiter in line takes over instead of hanging"""
+
+    def __init__(self):
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.inflight
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        while key in self.inflight:
+            inflight = self.inflight[key]
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():  # We were cancelled ourselves, not the call we were waiting on
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.inflight[key]
+
+
+class AsyncTTLCache:
+    """Caches the results of an async lookup, with separate lifetimes for found (positive) and
+    missing (None, negative) values. Concurrent lookups of the same key share a single call"""
+
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int = 4096):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+
+        # Key -> (expiry, value), least recently used first
+        self.entries: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self.flights = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+
+    def set(self, key: Hashable, value: Any):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: Hashable, loader: Callable[[Hashable], Awaitable[Any]]) -> Any:
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        return await self.flights.run(key, lambda: self.load(key, loader))
+
+    @property
+    def coalesced(self) -> int:
+        return self.flights.coalesced
+
+    async def load(self, key: Hashable, loader: Callable[[Hashable], Awaitable[Any]]) -> Any:
+        # Errors are shared with waiters but never cached
+        self.misses += 1
+        value = await loader(key)
+        self.set(key, value)
+        return value
+
+
+class RandomDocs:
+    """Picks random documents from a collection in O(1) by keeping every _id in memory, instead of
+    running $sample over the whole collection. The ids are reloaded in the background once stale"""
+
+    def __init__(self, collection: AsyncIOMotorCollection, query: Optional[dict] = None, max_age: float = 3600):
+        self.collection = collection
+        self.query = query or {}
+        self.max_age = max_age
+
+        # Flat list for O(1) picks, plus each id's position in it for O(1) removals
+        self.ids: List[Any] = []
+        self.positions: Dict[Any, int] = {}
+        self.loaded_at: Optional[float] = None
+        self.loading: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    async def load(self):
+        ids = [doc['_id'] async for doc in self.collection.find(self.query, {'_id': 1})]
+        self.ids = ids
+        self.positions = {_id: i for i, _id in enumerate(ids)}
+        self.loaded_at = time.monotonic()
+
+    def reload(self) -> asyncio.Task:
+        if not self.loading or self.loading.done():
+            self.loading = asyncio.create_task(self.load())
+        return self.loading
+
+    def add(self, _id: Any):
+        if _id not in self.positions:
+            self.positions[_id] = len(self.ids)
+            self.ids.append(_id)
+
+    def discard(self, _id: Any):
+        pos = self.positions.pop(_id, None)
+        if pos is None:
+            return
+        last = self.ids.pop()
+        if pos < len(self.ids):  # Fill the hole with the last id
+            self.ids[pos] = last
+            self.positions[last] = pos
+
+    async def pick(self, exclude: Container = (), attempts: int = 5) -> Optional[dict]:
+        if self.loaded_at is None:
+            await asyncio.shield(self.reload())
+        elif time.monotonic() - self.loaded_at > self.max_age:
+            self.reload()
 
-        return webhook
+        for _ in range(attempts):
+            if not self.ids:
+                return None
+            _id = random.choice(self.ids)
+            if _id in exclude:
+                continue
+            doc = await self.collection.find_one({'_id': _id})
+            if doc:
+                return doc
+            self.discard(_id)  # Deleted since the last reload
 
 
 def truncate_string(s: str, maxlen=2000, suffix='..'):
@@ -1,19 +1,23 @@
 from discord.ext import commands
 
+from cogs import utils
+
 
 class Yeller(commands.Cog, name="Yeller"):
 
     def __init__(self, bot):
         self.bot = bot
         self.yells = self.bot.db['yells']
+        self.random_yells = utils.RandomDocs(self.yells)
 
     async def get_yell(self):
-        pipeline = [{'$sample': {'size': 1}}]
-        async for doc in self.yells.aggregate(pipeline):
+        doc = await self.random_yells.pick()
+        if doc:
             return doc['m']
 
     async def save_yell(self, message: str):
-        await self.yells.insert_one({'m': message})
+        result = await self.yells.insert_one({'m': message})
+        self.random_yells.add(result.inserted_id)
 
     @staticmethod
     def is_message_yell(message: str) -> bool: